@@ -26,7 +26,7 @@ fi
 git diff --cached --name-status | while read status file; do
 	if [[ "$file" =~ ^patches/ ]] || [[ "$file" =~ ^staging/ ]]; then
 		warning "UPDATING AUTOGENERATED FILES"
-		./staging/patchupdate.py || exit 1
+		./staging/patchupdate.py --staged || exit 1
 		break;
 	fi
 done
@@ -0,0 +1,445 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Benchmark for the patch tools, based on a synthetic wine repository and patch tree.
+#
+# Copyright (C) 2017 Wine Staging Team
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import argparse
+import contextlib
+import difflib
+import json
+import os
+import patchupdate
+import patchutils
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+class config(object):
+    path_baseline           = ".patchbench.json"
+
+    threshold               = 0.10
+    min_difference          = 0.005
+
+    # Minimum distance between changes of unrelated patchsets, larger than the diff context
+    anchor_distance         = 8
+
+class BenchmarkError(RuntimeError):
+    """Failed to run benchmark."""
+    pass
+
+class _Tree(object):
+    """Synthetic wine repository and patch tree, and the inputs for the individual benchmarks."""
+    def __init__(self, path):
+        self.path           = path
+        self.files          = {}
+        self.patchsets      = []
+        self.patch_files    = []
+        self.apply_tasks    = []
+        self.ifdef_tasks    = []
+
+def _c_source(rng, name, size):
+    """Generate a C source file with roughly the given number of lines."""
+    lines = ["/*", " * %s" % name, " */", "", "#include \"config.h\"", "#include <stdio.h>", ""]
+    k = 0
+    while len(lines) < size:
+        lines.append("static int func%d(int a, const char *str)" % k)
+        lines.append("{")
+        lines.append("    int x = a + %d;" % k)
+        for _ in xrange(rng.randint(4, 16)):
+            r = rng.random()
+            if r < 0.1:
+                lines.append("    /* comment %d" % rng.randint(0, 9999))
+                lines.append("       continued */")
+            elif r < 0.15:
+                lines.append("#ifdef HAVE_FEATURE%d" % rng.randint(0, 9))
+                lines.append("    x += %d;" % rng.randint(0, 9999))
+                lines.append("#endif")
+            elif r < 0.3:
+                lines.append("    TRACE(\"(%%d, %%s) step %d\\n\", a, str);" % rng.randint(0, 9999))
+            elif r < 0.45:
+                lines.append("    if (!str) return %d;" % rng.randint(0, 9999))
+            else:
+                lines.append("    x = call%d(x, str); // %d" % (rng.randint(0, 99), rng.randint(0, 9999)))
+        lines.append("    return x;")
+        lines.append("}")
+        lines.append("")
+        k += 1
+    return lines
+
+def _generate_files(rng, num_files, size):
+    """Generate the content of the synthetic wine repository."""
+    files = {}
+    files["configure.ac"] = ["AC_INIT([Wine])", ""] + \
+                            ["WINE_CONFIG_DLL(dll%d)" % k for k in xrange(num_files * size // 100)] + ["", "AC_OUTPUT"]
+    for k in xrange(num_files - 1):
+        if k % 4 == 3:
+            filename = "include/header%d.h" % k
+            files[filename] = ["/* %s */" % filename, ""] + \
+                              ["#define VALUE%d_%d %d" % (k, n, rng.randint(0, 9999)) for n in xrange(size // 2)]
+        else:
+            filename = "dlls/dll%d/file%d.c" % (k // 4, k)
+            files[filename] = _c_source(rng, filename, size)
+    return files
+
+def _anchors(rng, filename, lines):
+    """Return the lines which can be modified by patchsets, with enough distance between them."""
+    if filename.endswith(".c"):
+        candidates = [n for n, line in enumerate(lines) if line.startswith("    x = call")]
+    elif filename.endswith(".h"):
+        candidates = [n for n, line in enumerate(lines) if line.startswith("#define ")]
+    else:
+        candidates = [n for n, line in enumerate(lines) if line.startswith("WINE_CONFIG_DLL(")]
+    rng.shuffle(candidates)
+
+    used = []
+    for n in candidates:
+        if all([abs(n - m) >= config.anchor_distance for m in used]):
+            used.append(n)
+    return used
+
+def _changed_lines(rng, filename, name, line):
+    """Return the replacement for a line modified by a patchset."""
+    ident = name.replace("-", "_")
+    if filename.endswith(".c"):
+        result = ["    x = %s(x, str);" % ident]
+        if rng.random() < 0.5:
+            result.append("    TRACE(\"%s %%d\\n\", x);" % name)
+        return result
+    elif filename.endswith(".h"):
+        return ["%s /* %s */" % (line, name)]
+    else:
+        return [line, "WINE_CONFIG_DLL(%s)" % ident.lower()]
+
+def _render(lines, changes, closure):
+    """Return the content of a file after applying the changes of a set of patchsets."""
+    result = []
+    for n, line in enumerate(lines):
+        latest = None
+        for i, changed in changes.get(n, []):
+            if i in closure:
+                latest = changed
+        result.extend(latest if latest is not None else [line])
+    return result
+
+def _unified_diff(filename, before, after):
+    """Return a unified diff between two versions of a file, without the 'diff --git' header."""
+    diff = difflib.unified_diff([line + "\n" for line in before], [line + "\n" for line in after],
+                                "a/%s" % filename, "b/%s" % filename, n=3)
+    return "".join(diff)
+
+def _git(path, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME="Wine Staging Team", GIT_AUTHOR_EMAIL="webmaster@fds-team.de",
+               GIT_AUTHOR_DATE="2017-01-01T00:00:00+0000", GIT_COMMITTER_NAME="Wine Staging Team",
+               GIT_COMMITTER_EMAIL="webmaster@fds-team.de", GIT_COMMITTER_DATE="2017-01-01T00:00:00+0000")
+    with open(os.devnull, "wb") as devnull:
+        subprocess.check_call(["git"] + list(args), cwd=path, env=env, stdout=devnull)
+
+def generate_tree(path, seed=1, num_patchsets=200, num_files=40, size=2000, conflicts=0.2):
+    """Generate a wine repository and a patch tree. Unrelated patchsets modify lines which are
+    far apart, the given fraction of changes modifies the same lines as an earlier patchset
+    and therefore depends on it."""
+    rng  = random.Random(seed)
+    tree = _Tree(path)
+    tree.files = _generate_files(rng, num_files, size)
+
+    # Create the repository
+    wine = os.path.join(path, patchupdate.config.path_wine)
+    os.makedirs(wine)
+    _git(wine, "init", "-q")
+    for filename, lines in sorted(tree.files.iteritems()):
+        filename = os.path.join(wine, filename)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, "wb") as fp:
+            fp.write("".join([line + "\n" for line in lines]))
+    _git(wine, "add", "-A")
+    _git(wine, "commit", "-q", "-m", "Synthetic wine tree.")
+    _git(wine, "update-ref", "refs/remotes/origin/master", "HEAD")
+
+    # Decide which lines are modified by each patchset
+    anchors  = dict([(f, _anchors(rng, f, lines)) for f, lines in sorted(tree.files.iteritems())])
+    filelist = sorted(tree.files)
+    changes  = dict([(f, {}) for f in filelist])
+    latest   = {}
+    names    = []
+    depends  = []
+    closures = []
+    modified = []
+
+    for _ in xrange(num_patchsets):
+        deps  = set()
+        edits = []
+        for _ in xrange(rng.randint(1, 3)):
+            if len(latest) and rng.random() < conflicts:
+                f, n = rng.choice(sorted(latest))
+                deps.add(latest[(f, n)])
+            else:
+                f = "configure.ac" if rng.random() < 0.3 else rng.choice(filelist)
+                if len(anchors[f]) == 0:
+                    continue
+                n = anchors[f].pop()
+            if (f, n) in edits:
+                continue
+            edits.append((f, n))
+
+        if len(edits) == 0:
+            continue
+
+        i = len(names)
+        f = edits[0][0]
+        names.append("%s-Change%04d" % (f.split("/")[1] if "/" in f else "configure", i))
+        depends.append(sorted(deps))
+        closures.append(set([i]).union(*[closures[j] for j in deps]))
+        modified.append(sorted(set([f for f, _ in edits])))
+        for f, n in edits:
+            changes[f].setdefault(n, []).append((i, _changed_lines(rng, f, names[i], tree.files[f][n])))
+            latest[(f, n)] = i
+
+    # Write the patch tree
+    tree.patchsets = names
+    patches = os.path.join(path, patchupdate.config.path_patches)
+    os.makedirs(patches)
+    for i, name in enumerate(names):
+        directory = os.path.join(patches, name)
+        os.makedirs(directory)
+        with open(os.path.join(directory, "definition"), "wb") as fp:
+            fp.write("Fixes: [%d] Synthetic change %d\n" % (10000 + i, i))
+            for j in depends[i]:
+                fp.write("Depends: %s\n" % names[j])
+
+        for k, f in enumerate(modified[i]):
+            before = _render(tree.files[f], changes[f], closures[i] - set([i]))
+            after  = _render(tree.files[f], changes[f], closures[i])
+            diff   = _unified_diff(f, before, after)
+            tree.apply_tasks.append(("".join([line + "\n" for line in before]), diff))
+            if not f.endswith(".ac"):
+                tree.ifdef_tasks.append(("".join([line + "\n" for line in before]),
+                                         "".join([line + "\n" for line in after])))
+
+            filename = os.path.join(directory, "%04d-%s-Change-%d.patch" % (k + 1, os.path.basename(f), i))
+            with open(filename, "wb") as fp:
+                fp.write("From: Wine Staging Team <webmaster@fds-team.de>\n")
+                fp.write("Subject: %s: Change %d.\n" % (os.path.basename(f), i))
+                fp.write("\n")
+                fp.write("---\n")
+                fp.write("diff --git a/%s b/%s\n" % (f, f))
+                fp.write("index 0000000..1111111 100644\n")
+                fp.write(diff)
+                fp.write("-- \n")
+                fp.write("2.11.0\n")
+                fp.write("\n")
+            tree.patch_files.append(filename)
+
+    return tree
+
+@contextlib.contextmanager
+def _quiet():
+    """Hide the output (progress bars) of the benchmarked functions."""
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def _reset_caches(parse=True, results=True):
+    """Drop the in-memory and on-disk caches of patchupdate and patchutils."""
+    if parse and os.path.exists(patchupdate.config.path_parse_cache):
+        os.unlink(patchupdate.config.path_parse_cache)
+    if results:
+        if patchupdate._apply_cache is not None:
+            patchupdate._apply_cache.close()
+            patchupdate._apply_cache = None
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(patchupdate.config.path_cache + suffix):
+                os.unlink(patchupdate.config.path_cache + suffix)
+    patchutils._preprocessed.clear()
+
+def _benchmarks(tree, jobs):
+    """Return the (name, setup, run) tuples of all benchmarks."""
+    state = {}
+
+    def _read_patch():
+        for filename in tree.patch_files:
+            list(patchutils.read_patch(filename))
+
+    def _apply_patch():
+        for original, diff in tree.apply_tasks:
+            patchutils.apply_patch(patchutils.MemoryFile(original), patchutils.MemoryFile(diff), fuzz=0)
+
+    def _load_patchsets():
+        patchupdate.load_patchsets(jobs=jobs)
+
+    def _generate_ifdef_patch():
+        for original, patched in tree.ifdef_tasks:
+            patchutils.generate_ifdef_patch(patchutils.MemoryFile(original), patchutils.MemoryFile(patched),
+                                            ifdef="STAGING_BENCHMARK")
+
+    def _setup_apply_order(cached):
+        _reset_caches(results=not cached)
+        state['all_patches'] = patchupdate.load_patchsets(jobs=jobs)
+
+    def _generate_apply_order():
+        patchupdate.generate_apply_order(state['all_patches'], jobs=jobs)
+
+    return [("read_patch",                  _reset_caches,                          _read_patch),
+            ("apply_patch",                 _reset_caches,                          _apply_patch),
+            ("load_patchsets",              _reset_caches,                          _load_patchsets),
+            ("load_patchsets/cached",       _load_patchsets,                        _load_patchsets),
+            ("generate_ifdef_patch",        _reset_caches,                          _generate_ifdef_patch),
+            ("generate_apply_order",        lambda: _setup_apply_order(False),      _generate_apply_order),
+            ("generate_apply_order/cached", lambda: _setup_apply_order(True),       _generate_apply_order)]
+
+def run_benchmarks(tree, repeat=3, jobs=1, selected=None):
+    """Run the benchmarks in the given tree, returns the minimum and median time of each benchmark."""
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(tree.path)
+    try:
+        patchupdate.upstream_commit = patchupdate._upstream_commit()
+        patchupdate.prefetch_wine_files(sorted(tree.files))
+
+        for name, setup, run in _benchmarks(tree, jobs):
+            if selected is not None and name not in selected:
+                continue
+            times = []
+            for _ in xrange(repeat):
+                with _quiet():
+                    setup()
+                    start = time.time()
+                    run()
+                    times.append(time.time() - start)
+            times.sort()
+            results[name] = {'min': times[0], 'median': times[len(times) // 2]}
+            print " %-32s %8.3fs %8.3fs" % (name, times[0], times[len(times) // 2])
+    finally:
+        if patchupdate._apply_cache is not None:
+            patchupdate._apply_cache.close()
+            patchupdate._apply_cache = None
+        if patchupdate._wine_blobs is not None and patchupdate._wine_blobs.process is not None:
+            patchupdate._wine_blobs.process.stdin.close()
+            patchupdate._wine_blobs.process.wait()
+        patchupdate._wine_blobs = None
+        os.chdir(cwd)
+    return results
+
+def compare_results(results, baseline, threshold):
+    """Compare the minimum times against a baseline, returns a list of regressions."""
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['min']
+        after  = result['min']
+        change = (after - before) / before if before > 0 else 0.0
+        print " %-32s %8.3fs -> %8.3fs %+6.1f%%" % (name, before, after, change * 100)
+        if change > threshold and after - before > config.min_difference:
+            regressions.append((name, change))
+    return regressions
+
+if __name__ == "__main__":
+
+    def _check_positive(value):
+        if not value.isdigit() or int(value) < 1:
+            raise argparse.ArgumentTypeError("not a positive number")
+        return int(value)
+
+    def _check_fraction(value):
+        try:
+            value = float(value)
+        except ValueError:
+            value = -1
+        if value < 0 or value > 1:
+            raise argparse.ArgumentTypeError("not a number between 0 and 1")
+        return value
+
+    parser = argparse.ArgumentParser(description="Benchmark the patch tools with a synthetic patch tree.")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the patch tree generator")
+    parser.add_argument('--patchsets', type=_check_positive, default=200, help="Number of patchsets")
+    parser.add_argument('--files', type=_check_positive, default=40, help="Number of files in the repository")
+    parser.add_argument('--size', type=_check_positive, default=2000, help="Number of lines per file")
+    parser.add_argument('--conflicts', type=_check_fraction, default=0.2, help="Fraction of conflicting changes")
+    parser.add_argument('--repeat', type=_check_positive, default=3, help="Number of runs of each benchmark")
+    parser.add_argument('--jobs', type=_check_positive, default=1, help="Number of parallel jobs")
+    parser.add_argument('--benchmark', action='append', metavar="NAME", help="Only run the given benchmark")
+    parser.add_argument('--baseline', metavar="FILE", default=config.path_baseline, help="Baseline for comparisons")
+    parser.add_argument('--save', action='store_true', help="Store the results as the new baseline")
+    parser.add_argument('--threshold', type=_check_fraction, default=config.threshold,
+                        help="Report benchmarks which are slower than the baseline by more than this fraction")
+    parser.add_argument('--workdir', metavar="DIR", help="Generate the patch tree in the given (new) directory and keep it")
+    args = parser.parse_args()
+
+    params = {'seed': args.seed, 'patchsets': args.patchsets, 'files': args.files,
+              'size': args.size, 'conflicts': args.conflicts, 'jobs': args.jobs}
+
+    try:
+        baseline = None
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as fp:
+                baseline = json.load(fp)
+            if baseline.get('version') != 1 or baseline.get('params') != params:
+                if not args.save:
+                    raise BenchmarkError("Baseline %s was created with different parameters, use --save to replace it" %
+                                         args.baseline)
+                baseline = None
+
+        path = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="patchbench-")
+        try:
+            tree = generate_tree(path, seed=args.seed, num_patchsets=args.patchsets, num_files=args.files,
+                                 size=args.size, conflicts=args.conflicts)
+            print ""
+            print "Benchmarking %d patchsets, %d patch files" % (len(tree.patchsets), len(tree.patch_files))
+            print ""
+            results = run_benchmarks(tree, repeat=args.repeat, jobs=args.jobs, selected=args.benchmark)
+            print ""
+        finally:
+            if args.workdir is None:
+                shutil.rmtree(path)
+
+        regressions = []
+        if baseline is not None:
+            print "Comparison with baseline %s:" % args.baseline
+            print ""
+            regressions = compare_results(results, baseline['results'], args.threshold)
+            print ""
+
+        if args.save:
+            if baseline is not None:
+                baseline['results'].update(results)
+                results = baseline['results']
+            with open(args.baseline, "w") as fp:
+                json.dump({'version': 1, 'params': params, 'results': results}, fp, indent=2, sort_keys=True)
+                fp.write("\n")
+
+        if len(regressions):
+            for name, change in regressions:
+                print "REGRESSION: %s is %.1f%% slower than the baseline" % (name, change * 100)
+            print ""
+            exit(1)
+
+    except (BenchmarkError, patchupdate.PatchUpdaterError) as e:
+        print ""
+        print "ERROR: %s" % e
+        print ""
+        exit(1)
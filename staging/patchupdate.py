@@ -24,33 +24,47 @@
 from patchutils import escape_sh, escape_c
 import argparse
 import binascii
+import bisect
 import cPickle as pickle
+import collections
 import contextlib
 import fnmatch
 import hashlib
 import itertools
+import json
 import math
+import multiprocessing
 import multiprocessing.pool
 import operator
 import os
 import patchutils
 import progressbar
 import re
+import resource
 import signal
+import sqlite3
 import subprocess
 import sys
-import tempfile
 import textwrap
+import threading
+import time
 import xmlrpclib
+import zlib
 import ConfigParser
 
 _devnull = open(os.devnull, 'wb')
 
 # Cached information to speed up patch dependency checks
 upstream_commit = None
+_wine_blobs     = None
+_apply_cache    = None
+
+# Counters and timers for --profile and --stats-json, None if disabled
+_stats          = None
 
 class config(object):
-    path_cache              = ".patchupdate.cache"
+    path_cache              = ".patchupdate.db"
+    path_parse_cache        = ".patchupdate.parse"
     path_config             = os.path.expanduser("~/.config/patchupdate.conf")
 
     path_patches            = "patches"
@@ -62,11 +76,22 @@ class config(object):
 
     path_IfDefined          = "9999-IfDefined.patch"
 
+    apply_cache_limit       = 256 * 1024 * 1024
+    apply_cache_disk_limit  = 64 * 1024 * 1024
+    cache_max_files         = 100000
+    cache_max_subsets       = 1000000
+
+    verify_chunk_size       = 20
+    verify_default_cost     = 0.002
+
     bugtracker_url          = "https://bugs.winehq.org/xmlrpc.cgi"
     bugtracker_defaultcc    = ["michael@fds-team.de", "sebastian@fds-team.de",
                                "erich.e.hoover@wine-staging.com", "dmitry@baikal.ru"]
     bugtracker_user         = None
     bugtracker_pass         = None
+    bugtracker_cache_ttl    = 6 * 3600
+    bugtracker_batch_size   = 100
+    bugtracker_jobs         = 4
 
     github_url              = "https://github.com/wine-compholio/wine-staging"
 
@@ -91,7 +116,7 @@ class PatchSet(object):
         self.depends        = set()
         self.auto_depends   = set()
 
-        self.verify_time    = None
+        self.verify_depends = 0
 
 def _pairs(a):
     """Iterate over all pairs of elements contained in the list a."""
@@ -123,6 +148,623 @@ def _split_seq(iterable, size):
         yield items
         items = list(itertools.islice(it, size))
 
+class _ApplyCache(object):
+    """Content-addressed cache for the results of applying patches. Results are indexed by the hash
+    of the original content and the hash of the patch, identical states are only stored once.
+    Results can optionally be kept in a database, to reuse them in later runs."""
+
+    _missing = object()
+
+    def __init__(self, limit, filename=None):
+        self.limit    = limit
+        self.size     = 0
+        self.results  = collections.OrderedDict()
+        self.contents = collections.OrderedDict()
+        self.lock     = threading.Lock()
+        self.db       = None
+
+        if filename is not None:
+            self.now = time.time()
+            self.db  = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS applied (input BLOB, patch BLOB, output BLOB, last_used REAL, "
+                                "PRIMARY KEY (input, patch))")
+                self.db.execute("CREATE TABLE IF NOT EXISTS states (hash BLOB PRIMARY KEY, content BLOB, "
+                                "size INTEGER, last_used REAL)")
+
+    def close(self):
+        """Remove the least recently used entries from the database and close it."""
+        with self.lock:
+            if self.db is not None:
+                self._close_db()
+
+    def _close_db(self):
+        with self.db:
+            total = self.db.execute("SELECT sum(size) FROM states").fetchone()[0] or 0
+            for digest, size in self.db.execute("SELECT hash, size FROM states ORDER BY last_used").fetchall():
+                if total <= config.apply_cache_disk_limit:
+                    break
+                self.db.execute("DELETE FROM states WHERE hash = ?", (digest,))
+                total -= size
+            self.db.execute("DELETE FROM applied WHERE rowid IN (SELECT rowid FROM applied ORDER BY last_used "
+                            "LIMIT max(0, (SELECT count(*) FROM applied) - ?))", (config.cache_max_subsets,))
+        self.db.close()
+        self.db = None
+
+    def _evict(self):
+        while self.size > self.limit and len(self.contents) > 1:
+            _, (lines, size) = self.contents.popitem(last=False)
+            self.size -= size
+        while self.size > self.limit and len(self.results) > 1:
+            self.results.popitem(last=False)
+            self.size -= 128
+
+    def _lookup_result(self, key, persist):
+        with self.lock:
+            digest = self.results.pop(key, self._missing)
+            if digest is not self._missing:
+                self.results[key] = digest
+                return digest
+        if not persist:
+            return self._missing
+
+        # The database is shared by all threads, it is only accessed while holding the lock
+        with self.lock:
+            if self.db is None:
+                return self._missing
+            with self.db:
+                self.db.execute("UPDATE applied SET last_used = ? WHERE input = ? AND patch = ?",
+                                (self.now, sqlite3.Binary(key[0]), sqlite3.Binary(key[1])))
+                row = self.db.execute("SELECT output FROM applied WHERE input = ? AND patch = ?",
+                                      (sqlite3.Binary(key[0]), sqlite3.Binary(key[1]))).fetchone()
+            if row is None:
+                return self._missing
+            digest = str(row[0]) if row[0] is not None else None
+            self.results[key] = digest
+            self.size += 128
+            self._evict()
+        return digest
+
+    def _lookup_content(self, digest, persist):
+        with self.lock:
+            entry = self.contents.pop(digest, None)
+            if entry is not None:
+                self.contents[digest] = entry
+                return entry[0]
+        if not persist:
+            return None
+
+        with self.lock:
+            if self.db is None:
+                return None
+            with self.db:
+                self.db.execute("UPDATE states SET last_used = ? WHERE hash = ?", (self.now, sqlite3.Binary(digest)))
+                row = self.db.execute("SELECT content FROM states WHERE hash = ?", (sqlite3.Binary(digest),)).fetchone()
+        if row is None:
+            return None
+        content = zlib.decompress(str(row[0]))
+        lines = patchutils.split_lines(content)
+        with self.lock:
+            if not self.contents.has_key(digest):
+                self.contents[digest] = (lines, len(content))
+                self.size += len(content)
+                self._evict()
+        return lines
+
+    def _store(self, key, lines, persist):
+        if lines is None:
+            content = digest = None
+        else:
+            content = "\n".join(lines) + "\n" if len(lines) else ""
+            digest  = hashlib.sha256(content).digest()
+
+        with self.lock:
+            if not self.results.has_key(key):
+                self.size += 128
+            self.results[key] = digest
+            if digest is not None:
+                entry = self.contents.pop(digest, None)
+                if entry is None:
+                    entry = (lines, len(content))
+                    self.size += entry[1]
+                self.contents[digest] = entry
+                lines = entry[0]
+            self._evict()
+
+            if persist and self.db is not None:
+                self._persist(key, digest, content)
+        return digest, lines
+
+    def _persist(self, key, digest, content):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO applied VALUES (?, ?, ?, ?)",
+                            (sqlite3.Binary(key[0]), sqlite3.Binary(key[1]),
+                             sqlite3.Binary(digest) if digest is not None else None, self.now))
+            if digest is not None:
+                self.db.execute("INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)",
+                                (sqlite3.Binary(digest), sqlite3.Binary(zlib.compress(content)),
+                                 len(content), self.now))
+
+    def apply(self, base_hash, base_lines, patches, persist=False):
+        """Apply a list of (patch hash, sections) tuples in order, returns the hash and lines of the
+        result. Known results are reused, failures are cached and raise PatchApplyError again."""
+        state, lines, k = base_hash, base_lines, 0
+
+        # Follow the known results as far as possible
+        digest = base_hash
+        for n, (patch_hash, sections) in enumerate(patches):
+            digest = self._lookup_result((digest, patch_hash), persist)
+            if digest is self._missing:
+                break
+            if digest is None:
+                raise patchutils.PatchApplyError("Failed to apply patch (cached).")
+            cached = self._lookup_content(digest, persist)
+            if cached is not None:
+                state, lines, k = digest, cached, n + 1
+
+        _stat(("cache", "apply", "hits"), k)
+        _stat(("cache", "apply", "misses"), len(patches) - k)
+
+        for patch_hash, sections in patches[k:]:
+            try:
+                with _StatTimer(("patch",)):
+                    lines = patchutils.apply_sections(lines, sections)
+            except patchutils.PatchApplyError:
+                self._store((state, patch_hash), None, persist)
+                raise
+            state, lines = self._store((state, patch_hash), lines, persist)
+        return state, lines
+
+class _VerifyJob(object):
+    """Information required to check all combinations of patches modifying a single file."""
+    def __init__(self, filename, indices):
+        self.filename       = filename
+        self.indices        = indices
+        self.depends        = {}
+        self.groups         = [indices]
+        self.masks          = []
+        self.total          = 0
+        self.unique_hash    = None
+        self.cost           = 0.0
+
+        self.original_hash  = None
+        self.digests        = {}
+        self.verified       = set()
+        self.original_lines = None
+        self.sections       = None
+
+        self.original       = None
+        self.patches        = {}
+
+def _worker_init():
+    """Initialize a worker process. Pools are started while other stages are running in
+    threads of the parent process, so the inherited locks have to be recreated."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    patchutils.reinit_after_fork()
+    if _apply_cache is not None:
+        _apply_cache.lock = threading.Lock()
+
+# Per-process state of the verification workers
+_verify_jobs     = None
+_verify_deadline = None
+
+def _verify_init(jobs, apply_cache_limit, deadline=None, worker=True):
+    """Initialize a verification worker, the apply cache is inherited from the parent process."""
+    global _verify_jobs, _verify_deadline
+    if worker:
+        _worker_init()
+    _verify_jobs     = jobs
+    _verify_deadline = deadline
+    get_apply_cache().limit = apply_cache_limit
+
+def _verify_subset(job, k, current):
+    """Return the full combination of patches to check for a subset of a group, or None."""
+
+    # Check if there is any patch which is skipped, but another applied patch depends on it.
+    # If this is the case we found an impossible situation, we can be skipped in this test.
+    applied = 0
+    depends = 0
+    for i in current:
+        applied |= 1 << i
+        depends |= job.depends[i]
+    if depends & job.masks[k] & ~applied:
+        return None # we can skip this test
+
+    # Add dependencies from other groups
+    applied |= depends
+    return tuple([j for j in job.indices if (applied >> j) & 1])
+
+def _verify_apply(job, current):
+    """Check if a combination of patches applies."""
+    try:
+        if job.sections is not None:
+            get_apply_cache().apply(job.original_hash, job.original_lines,
+                                    [(job.digests[i], job.sections[i]) for i in current])
+            return True
+    except patchutils.PatchUnsupportedError:
+        pass
+    except patchutils.PatchApplyError:
+        return False
+
+    original = open(job.original)
+    try:
+        for i in current:
+            with open(job.patches[i]) as patchfile, _StatTimer(("patch",)):
+                patched = patchutils.apply_patch(original, patchfile, fuzz=0)
+            original.close()
+            original = patched
+    except patchutils.PatchApplyError:
+        return False
+    finally:
+        original.close()
+
+    return True # everything is fine
+
+def _verify_chunk(task):
+    """Check a chunk of patch combinations for a job, returns the first failed combination
+    (or None), the hashes of all combinations which were successfully checked, the time spent
+    and the statistics. Chunks are skipped after the deadline, the hashes are None in this case."""
+    job = _verify_jobs[task[0]]
+    if _verify_deadline is not None and time.time() > _verify_deadline:
+        return None, None, 0.0, _stat_take()
+
+    start = time.time()
+    failed, verified = _verify_combinations(job, task[1])
+    elapsed = time.time() - start
+    _stat(("files", job.filename, "calls"))
+    _stat(("files", job.filename, "time"), elapsed)
+    return failed, verified, elapsed, _stat_take()
+
+def _verify_combinations(job, chunk):
+    """Check the combinations of a chunk, returns the first failed combination and the verified hashes."""
+    verified = []
+    for k, current in chunk:
+        current = _verify_subset(job, k, current)
+        if current is None:
+            continue
+
+        # Combinations are identified by the original content and the applied patches
+        m = hashlib.sha256()
+        m.update(job.original_hash)
+        for i in current:
+            m.update("P%s" % job.digests[i])
+        subset_hash = m.digest()
+        if subset_hash in job.verified:
+            _stat(("cache", "subsets", "hits"))
+            continue
+
+        _stat(("cache", "subsets", "misses"))
+        if not _verify_apply(job, current):
+            return current, verified
+        verified.append(subset_hash)
+
+    return None, verified
+
+class _ResultStore(object):
+    """Persistent store for verification results of files and individual combinations of
+    patches, based on SQLite in WAL mode, so concurrent runs don't lose results."""
+
+    def __init__(self, filename):
+        self.now = time.time()
+        self.db  = sqlite3.connect(filename, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (filename TEXT, hash BLOB, last_used REAL, "
+                            "PRIMARY KEY (filename, hash))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS subsets (hash BLOB PRIMARY KEY, filename TEXT, last_used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS subsets_filename ON subsets (filename)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS ifdef (hash BLOB PRIMARY KEY, diff BLOB, last_used REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS bugs (key TEXT PRIMARY KEY, data BLOB, last_used REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS costs (filename TEXT PRIMARY KEY, seconds REAL, "
+                            "combinations INTEGER, last_used REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS skipped (filename TEXT PRIMARY KEY, combinations INTEGER, "
+                            "last_used REAL)")
+
+    def close(self):
+        """Remove the least recently used entries and close the database."""
+        with self.db:
+            for table, limit in [("files", config.cache_max_files), ("subsets", config.cache_max_subsets),
+                                 ("ifdef", config.cache_max_files), ("bugs", config.cache_max_files),
+                                 ("costs", config.cache_max_files), ("skipped", config.cache_max_files)]:
+                self.db.execute("DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY last_used "
+                                "LIMIT max(0, (SELECT count(*) FROM %s) - ?))" % (table, table, table), (limit,))
+        self.db.close()
+
+    def has_file(self, filename, unique_hash):
+        """Check if all changes to a file were successfully verified before."""
+        with self.db:
+            cursor = self.db.execute("UPDATE files SET last_used = ? WHERE filename = ? AND hash = ?",
+                                     (self.now, filename, sqlite3.Binary(unique_hash)))
+            return cursor.rowcount > 0
+
+    def add_file(self, filename, unique_hash):
+        """Remember that all changes to a file were successfully verified."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                            (filename, sqlite3.Binary(unique_hash), self.now))
+
+    def get_costs(self):
+        """Return the time spent verifying each file as a dictionary of (seconds, combinations) tuples."""
+        with self.db:
+            return dict([(filename, (seconds, combinations)) for filename, seconds, combinations in
+                         self.db.execute("SELECT filename, seconds, combinations FROM costs")])
+
+    def add_cost(self, filename, seconds, combinations):
+        """Remember the time spent verifying a number of combinations of a file."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?)",
+                            (filename, seconds, combinations, self.now))
+
+    def get_skipped(self):
+        """Return the files which were not fully verified because of the time budget, and the
+        number of skipped combinations."""
+        with self.db:
+            return dict(self.db.execute("SELECT filename, combinations FROM skipped"))
+
+    def add_skipped(self, filename, combinations):
+        """Remember that a file was not fully verified, a value of None removes the entry."""
+        with self.db:
+            if combinations is None:
+                self.db.execute("DELETE FROM skipped WHERE filename = ?", (filename,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO skipped VALUES (?, ?, ?)", (filename, combinations, self.now))
+
+    def get_subsets(self, filename):
+        """Return the hashes of all previously verified combinations of patches for a file."""
+        with self.db:
+            self.db.execute("UPDATE subsets SET last_used = ? WHERE filename = ?", (self.now, filename))
+            return set([str(row[0]) for row in self.db.execute("SELECT hash FROM subsets WHERE filename = ?", (filename,))])
+
+    def get_ifdef(self, unique_hash):
+        """Return a previously generated #ifdef patch for a file, or None."""
+        with self.db:
+            self.db.execute("UPDATE ifdef SET last_used = ? WHERE hash = ?", (self.now, sqlite3.Binary(unique_hash)))
+            row = self.db.execute("SELECT diff FROM ifdef WHERE hash = ?", (sqlite3.Binary(unique_hash),)).fetchone()
+        return str(row[0]) if row is not None else None
+
+    def add_ifdef(self, unique_hash, diff):
+        """Remember a generated #ifdef patch for a file."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO ifdef VALUES (?, ?, ?)",
+                            (sqlite3.Binary(unique_hash), sqlite3.Binary(diff), self.now))
+
+    def get_bugs(self, keys):
+        """Return previously fetched bugtracker results as a dictionary of (data, time) tuples."""
+        result = {}
+        with self.db:
+            for chunk in _split_seq(keys, 500):
+                for key, data, fetched in self.db.execute("SELECT key, data, last_used FROM bugs WHERE key IN (%s)" %
+                                                          ", ".join(["?"] * len(chunk)), chunk):
+                    result[key] = (pickle.loads(str(data)), fetched)
+        return result
+
+    def add_bugs(self, entries):
+        """Remember bugtracker results, a value of None removes an entry."""
+        with self.db:
+            for key, data in entries.iteritems():
+                if data is None:
+                    self.db.execute("DELETE FROM bugs WHERE key = ?", (key,))
+                else:
+                    self.db.execute("INSERT OR REPLACE INTO bugs VALUES (?, ?, ?)",
+                                    (key, sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)), self.now))
+
+    def add_subsets(self, filename, hashes):
+        """Remember successfully verified combinations of patches."""
+        if len(hashes) == 0:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO subsets VALUES (?, ?, ?)",
+                                [(sqlite3.Binary(h), filename, self.now) for h in hashes])
+
+class _BlobServer(object):
+    """Fetch files from a git repository with a single 'git cat-file --batch' process,
+    the content of all requested objects is cached."""
+
+    def __init__(self, path):
+        self.path      = path
+        self.process   = None
+        self.cache     = {}
+        self.pending   = collections.deque()
+        self.requested = set()
+        self.cond      = threading.Condition()
+        self.lock      = threading.Lock()
+        self.failed    = False
+
+    def _start(self):
+        """Start the git process and a thread to read its output."""
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=self.path,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=_devnull)
+        thread = threading.Thread(target=self._reader)
+        thread.daemon = True
+        thread.start()
+
+    def _reader(self):
+        """Read the responses, which are returned in the same order as the requests."""
+        stdout = self.process.stdout
+        while True:
+            header = stdout.readline()
+            if header == "":
+                break
+            tmp = header.split()
+            content = None
+            if len(tmp) == 3 and tmp[2].isdigit():
+                content = stdout.read(int(tmp[2]))
+                stdout.read(1)
+                if tmp[1] != "blob":
+                    content = None
+            with self.cond:
+                self.cache[self.pending.popleft()] = content
+                self.cond.notify_all()
+
+        with self.cond:
+            self.failed = True
+            self.cond.notify_all()
+
+    def prefetch(self, entries):
+        """Request the given objects without waiting for the result."""
+        with self.lock:
+            if self.process is None:
+                self._start()
+            requests = []
+            with self.cond:
+                for entry in entries:
+                    if entry in self.requested:
+                        continue
+                    self.requested.add(entry)
+                    self.pending.append(entry)
+                    requests.append("%s\n" % entry)
+            if len(requests):
+                self.process.stdin.write("".join(requests))
+                self.process.stdin.flush()
+
+    def get(self, entry):
+        """Return the content of an object, or None if it doesn't exist."""
+        self.prefetch([entry])
+        with self.cond:
+            while entry not in self.cache:
+                if self.failed:
+                    raise PatchUpdaterError("Failed to read %s from git repository" % entry)
+                self.cond.wait()
+            return self.cache[entry]
+
+class _Scheduler(object):
+    """Run the stages of an update as soon as all stages they depend on are finished. Each stage
+    runs in its own thread and is called with the results of the stages it depends on."""
+
+    def __init__(self):
+        self.stages  = collections.OrderedDict()
+        self.results = {}
+        self.running = set()
+        self.error   = None
+        self.cond    = threading.Condition()
+
+    def add(self, name, func, requires=None):
+        """Add a stage, stages can only depend on previously added stages."""
+        if requires is None:
+            requires = []
+        assert all([r in self.stages for r in requires])
+        self.stages[name] = (func, requires)
+
+    def _run_stage(self, name, func, args):
+        result = None
+        try:
+            with _StatTimer(("stages", name)):
+                result = func(*args)
+        except Exception:
+            with self.cond:
+                if self.error is None:
+                    self.error = sys.exc_info()
+        with self.cond:
+            self.results[name] = result
+            self.running.remove(name)
+            self.cond.notify_all()
+
+    def run(self):
+        """Run all stages and return their results. After a failure no further stages are
+        started, the error is raised as soon as the running stages are finished."""
+        pending = list(self.stages)
+        with self.cond:
+            while True:
+                for name in list(pending):
+                    func, requires = self.stages[name]
+                    if self.error is None and all([r in self.results for r in requires]):
+                        pending.remove(name)
+                        self.running.add(name)
+                        thread = threading.Thread(target=self._run_stage,
+                                                  args=(name, func, [self.results[r] for r in requires]))
+                        thread.daemon = True
+                        thread.start()
+
+                if len(self.running) == 0:
+                    break
+
+                # Wake up regularly, otherwise CTRL+C would be ignored
+                self.cond.wait(0.5)
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.results
+
+class _Stats(object):
+    """Counters and timers of a run. Keys are tuples, values of keys ending with "max" are
+    maxima, everything else is summed up. Workers send the values collected since their
+    last result to the parent process."""
+
+    def __init__(self):
+        self.pid    = os.getpid()
+        self.lock   = threading.Lock()
+        self.values = {}
+
+    def _check_fork(self):
+        # Values (and the lock) inherited from the parent process belong to the parent
+        if self.pid != os.getpid():
+            self.pid    = os.getpid()
+            self.lock   = threading.Lock()
+            self.values = {}
+
+    def add(self, key, value=1):
+        self._check_fork()
+        with self.lock:
+            if key[-1] == "max":
+                self.values[key] = max(self.values.get(key, value), value)
+            else:
+                self.values[key] = self.values.get(key, 0) + value
+
+    def merge(self, values):
+        """Add values returned by take(), usually from a worker process."""
+        for key, value in values.iteritems():
+            self.add(key, value)
+
+    def take(self):
+        """Return all values and start again from zero."""
+        self._check_fork()
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def report(self):
+        """Return all values as nested dictionaries."""
+        self.add(("memory", "peak_kb", "max"), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        self.add(("memory", "peak_children_kb", "max"), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        result = {}
+        with self.lock:
+            for key, value in self.values.iteritems():
+                node = result
+                for k in key[:-1]:
+                    node = node.setdefault(k, {})
+                node[key[-1]] = value
+        return result
+
+def _stat(key, value=1):
+    """Update a counter, if statistics are enabled."""
+    if _stats is not None:
+        _stats.add(key, value)
+
+class _StatTimer(object):
+    """Measure the number of calls and the time spent in a block, if statistics are enabled."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if _stats is not None:
+            _stats.add(self.key + ("calls",))
+            _stats.add(self.key + ("time",), time.time() - self.start)
+
+def _stat_take():
+    """Return the statistics of a worker process, to be passed to _stat_merge in the parent."""
+    return _stats.take() if _stats is not None else None
+
+def _stat_merge(values):
+    if _stats is not None and values is not None:
+        _stats.merge(values)
+
 def _load_dict(filename):
     """Load a Python dictionary object from a file."""
     try:
@@ -180,53 +822,172 @@ def enum_patchsets(path):
         dirs.append((name, directory))
     return sorted(dirs)
 
-def load_patchsets():
+def _parse_definition(filename, content):
+    """Parse a definition file, returns a list of (key, value) tuples."""
+    result = []
+    for line in content.splitlines(True):
+        if line.startswith("#"):
+            continue
+        tmp = line.split(":", 1)
+        if len(tmp) != 2:
+            continue
+        result.append((tmp[0].lower(), tmp[1].strip()))
+    return result
+
+def _parse_patch(filename, content):
+    """Parse a patch file, returns a list of PatchObject objects."""
+    return list(patchutils.read_patch(filename))
+
+def _parse_cached(cache, filename, parse):
+    """Parse a file, or return the cached result if the file didn't change."""
+    st = os.stat(filename)
+    entry = cache['files'].get(filename)
+
+    # Size and modification time are only trusted if the file wasn't modified
+    # shortly before the entry was created, otherwise compare the content.
+    if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime and \
+       st.st_mtime < entry[2] - 1:
+        cache['used'][filename] = entry
+        _stat(("cache", "parse", "hits"))
+        return entry[4]
+
+    with open(filename, "rb") as fp:
+        content = fp.read()
+    digest = hashlib.sha256(content).digest()
+
+    if entry is not None and entry[3] == digest:
+        _stat(("cache", "parse", "hits"))
+        value = entry[4]
+    else:
+        _stat(("cache", "parse", "misses"))
+        value = parse(filename, content)
+
+    cache['used'][filename] = (st.st_size, st.st_mtime, time.time(), digest, value)
+    cache['changed'] = True
+    return value
+
+def _load_patchset(task):
+    """Read a single patchset directory, returns the PatchSet object (or None), the used cache entries
+    and the statistics."""
+    name, directory, entries = task
+    patch = PatchSet(name, directory)
+    cache = {'files': entries, 'used': {}, 'changed': False}
+
+    # Load the definition file
+    try:
+        patch.config = list(_parse_cached(cache, os.path.join(directory, "definition"), _parse_definition))
+    except (IOError, OSError):
+        pass
+
+    # Enumerate .patch files in the given directory, enumerate individual patches and affected files
+    for f in sorted(os.listdir(directory)):
+        if not re.match("^[0-9]{4}-.*\\.patch$", f):
+            continue
+        if f.startswith(config.path_IfDefined):
+            continue
+        if ("exclude", f) in patch.config:
+            continue
+        if not os.path.isfile(os.path.join(directory, f)):
+            continue
+        patch.files.append(f)
+        for p in _parse_cached(cache, os.path.join(directory, f), _parse_patch):
+            patch.modified_files.add(p.modified_file)
+            patch.patches.append(p)
+
+    # No single patch within this directory, ignore it
+    if len(patch.patches) == 0:
+        patch = None
+
+    return patch, cache['used'], cache['changed'], _stat_take()
+
+class _FileIndex(object):
+    """Index from modified files to patchsets, used to resolve glob patterns."""
+
+    def __init__(self, all_patches):
+        self.patchsets = {}
+        for i, patch in all_patches.iteritems():
+            for f in patch.modified_files:
+                self.patchsets.setdefault(f, set()).add(i)
+        self.files = sorted(self.patchsets.keys())
+        self.cache = {}
+
+    def match(self, pattern):
+        """Return the patchsets modifying any file which matches a glob pattern."""
+        if self.cache.has_key(pattern):
+            return self.cache[pattern]
+
+        # Literal patterns can be looked up directly, otherwise only check the
+        # files starting with the literal prefix of the pattern
+        r = re.search("[*?[]", pattern)
+        if r is None:
+            result = self.patchsets.get(pattern, set())
+        else:
+            prefix = pattern[:r.start()]
+            regex  = re.compile(fnmatch.translate(pattern))
+            result = set()
+            for f in itertools.islice(self.files, bisect.bisect_left(self.files, prefix), None):
+                if not f.startswith(prefix):
+                    break
+                if regex.match(f):
+                    result.update(self.patchsets[f])
+
+        self.cache[pattern] = result
+        return result
+
+def load_patchsets(jobs=None):
     """Read information about all patchsets."""
     unique_id   = itertools.count()
     all_patches = {}
     name_to_id  = {}
 
-    for name, directory in enum_patchsets(config.path_patches):
-        patch = PatchSet(name, directory)
-
-        # Load the definition file
-        try:
-            with open(os.path.join(directory, "definition")) as fp:
-                for line in fp:
-                    if line.startswith("#"):
-                        continue
-                    tmp = line.split(":", 1)
-                    if len(tmp) != 2:
-                        continue
-                    patch.config.append((tmp[0].lower(), tmp[1].strip()))
-        except IOError:
-            pass
+    # Parsed definition and patch files from previous runs
+    parse_cache = _load_dict(config.path_parse_cache)
+    if parse_cache.get('version') != 1:
+        parse_cache = {'version': 1, 'files': {}}
+
+    entries = {}
+    for filename, entry in parse_cache['files'].iteritems():
+        entries.setdefault(os.path.dirname(filename), {})[filename] = entry
+
+    # Read the patchset directories in parallel, results are processed in order
+    tasks = [(name, directory, entries.get(directory, {})) for name, directory in enum_patchsets(config.path_patches)]
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes=jobs, initializer=_worker_init)
+        results = pool.imap(_load_patchset, tasks, chunksize=8)
+    else:
+        pool = None
+        results = itertools.imap(_load_patchset, tasks)
 
-        # Enumerate .patch files in the given directory, enumerate individual patches and affected files
-        for f in sorted(os.listdir(directory)):
-            if not re.match("^[0-9]{4}-.*\\.patch$", f):
-                continue
-            if f.startswith(config.path_IfDefined):
-                continue
-            if ("exclude", f) in patch.config:
-                continue
-            if not os.path.isfile(os.path.join(directory, f)):
+    used    = {}
+    changed = False
+    try:
+        for patch, task_used, task_changed, task_stats in results:
+            _stat_merge(task_stats)
+            used.update(task_used)
+            changed = changed or task_changed
+            if patch is None:
                 continue
-            patch.files.append(f)
-            for p in patchutils.read_patch(os.path.join(directory, f)):
-                patch.modified_files.add(p.modified_file)
-                patch.patches.append(p)
-
-        # No single patch within this directory, ignore it
-        if len(patch.patches) == 0:
-            del patch
-            continue
 
-        i = next(unique_id)
-        all_patches[i]   = patch
-        name_to_id[name] = i
+            # Start fetching the original files while parsing the remaining patchsets
+            if upstream_commit is not None:
+                prefetch_wine_files(patch.modified_files)
+
+            i = next(unique_id)
+            all_patches[i]         = patch
+            name_to_id[patch.name] = i
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # Update the cache, entries for deleted files are dropped
+    if changed or len(used) != len(parse_cache['files']):
+        _save_dict(config.path_parse_cache, {'version': 1, 'files': used})
 
     # Now read the definition files in a second step
+    file_index = None
     for i, patch in all_patches.iteritems():
         for key, val in patch.config:
             if key == "depends":
@@ -235,14 +996,18 @@ def load_patchsets():
                 patch.depends.add(name_to_id[val])
 
             elif key == "apply-after":
-                for j, other_patch in all_patches.iteritems():
-                    if i != j and any([fnmatch.fnmatch(f, val) for f in other_patch.modified_files]):
+                if file_index is None:
+                    file_index = _FileIndex(all_patches)
+                for j in file_index.match(val):
+                    if i != j:
                         patch.auto_depends.add(j)
 
             elif key == "apply-before":
-                for j, other_patch in all_patches.iteritems():
-                    if i != j and any([fnmatch.fnmatch(f, val) for f in other_patch.modified_files]):
-                        other_patch.auto_depends.add(i)
+                if file_index is None:
+                    file_index = _FileIndex(all_patches)
+                for j in file_index.match(val):
+                    if i != j:
+                        all_patches[j].auto_depends.add(i)
 
             elif key == "fixes":
                 r = re.match("^\\[ *(!)? *([0-9]+) *\\](.*)$", val)
@@ -263,7 +1028,7 @@ def load_patchsets():
                 patch.ifdefined = val
 
             else:
-                print "WARNING: Ignoring unknown command in definition file for %s: %s" % (patch.name, line)
+                print "WARNING: Ignoring unknown command in definition file for %s: %s: %s" % (patch.name, key, val)
 
     # Filter autodepends on disabled patchsets
     for i, patch in all_patches.iteritems():
@@ -271,26 +1036,25 @@ def load_patchsets():
 
     return all_patches
 
-def causal_time_combine(a, b):
-    """Combines two timestamps into a new one."""
-    return [max(a, b) for a, b in zip(a, b)]
+def _mask(indices):
+    """Convert a list of patchset indices to a bitset."""
+    return reduce(operator.or_, [1 << i for i in indices], 0)
 
-def causal_time_smaller(a, b):
-    """Checks if timestamp a is smaller than timestamp b."""
-    return all([i <= j for i, j in zip(a,b)]) and any([i < j for i, j in zip(a,b)])
+def depends_on(all_patches, i, j):
+    """Checks if patchset i depends directly or indirectly on patchset j."""
+    return (all_patches[i].verify_depends >> j) & 1 != 0
 
-def causal_time_relation(all_patches, indices):
+def dependency_relation(all_patches, indices):
     """Checks if the dependencies of patches are compatible with a specific apply order."""
     for i, j in _pairs(indices):
-        if causal_time_smaller(all_patches[j].verify_time, all_patches[i].verify_time):
+        if depends_on(all_patches, i, j):
             return False
     return True
 
-def causal_time_relation_any(all_patches, indices):
-    """Similar to causal_time_relation(), but also check all possible permutations of indices."""
+def dependency_relation_any(all_patches, indices):
+    """Similar to dependency_relation(), but also check all possible permutations of indices."""
     for i, j in _pairs(indices):
-        if not (causal_time_smaller(all_patches[i].verify_time, all_patches[j].verify_time) or \
-                causal_time_smaller(all_patches[j].verify_time, all_patches[i].verify_time)):
+        if not (depends_on(all_patches, i, j) or depends_on(all_patches, j, i)):
             return False
     return True
 
@@ -302,24 +1066,158 @@ def contains_binary_patch(all_patches, indices, filename):
                 return True
     return False
 
+def _count_matches(lines, pattern, limit=2):
+    """Count the positions where pattern matches, stops counting at limit."""
+    count = 0
+    for pos in xrange(len(lines) - len(pattern) + 1):
+        if lines[pos] == pattern[0] and lines[pos:pos + len(pattern)] == pattern:
+            count += 1
+            if count >= limit:
+                break
+    return count
+
+def _creates_match(pattern, hunk):
+    """Check if the changes of a hunk could create a new occurrence of pattern. New occurrences
+    have to contain an added line (or both lines next to a deletion), the lines around the
+    changes are known from the context of the hunk."""
+    dst   = hunk.dstdata
+    start = hunk.prefix
+    end   = len(dst) - hunk.suffix
+    if start == end:
+        if start == 0 or end == len(dst):
+            return True # lines next to the deletion are unknown
+        start, end = start - 1, end + 1
+        required = 2
+    else:
+        required = 1
+
+    for pos in xrange(start - len(pattern) + 1, end):
+        lo = max(pos, start)
+        hi = min(pos + len(pattern), end)
+        if hi - lo < required:
+            continue
+        lo = max(pos, 0)
+        hi = min(pos + len(pattern), len(dst))
+        if dst[lo:hi] == pattern[lo - pos:hi - pos]:
+            return True
+    return False
+
+def patch_footprints(all_patches, indices, lines, sections):
+    """Determine the line ranges of the original file which are read or modified by each patchset.
+    Returns None if the position of a hunk could depend on unrelated patchsets, this is the case
+    for hunks without context, and if the lines of a hunk are not unique in the file."""
+    footprints = {}
+
+    for i in indices:
+        chain = [j for j in indices if depends_on(all_patches, i, j)]
+        others = [j for j in indices if j != i and j not in chain]
+        current = lines
+        origin  = range(len(lines))
+
+        for j in chain + [i]:
+            for _, hunks in sections[j]:
+                positions = []
+                result = patchutils.apply_hunks(current, hunks, positions=positions)
+
+                # Map the matched lines back to the original file, lines added by
+                # the dependencies are replaced by the nearest original lines.
+                if j == i:
+                    for hunk, pos in zip(hunks, positions):
+
+                        # Other patchsets must not be able to move the position of the hunk,
+                        # i.e. the lines have to be unique in all combinations of patchsets.
+                        if len(hunk.srcdata) == 0 or _count_matches(current, hunk.srcdata) != 1:
+                            return None
+                        for k in others:
+                            if any([_creates_match(hunk.srcdata, h) for _, other in sections[k] for h in other]):
+                                return None
+
+                        region = [k for k in origin[pos:pos + len(hunk.srcdata)] if k is not None]
+                        before = [k for k in origin[:pos] if k is not None]
+                        after  = [k for k in origin[pos + len(hunk.srcdata):] if k is not None]
+                        lo = min(region) if len(region) else (before[-1] if len(before) else 0)
+                        hi = max(region) if len(region) else (after[0] if len(after) else len(lines))
+
+                        # Hunks with less context on one side only match at the beginning or end
+                        if hunk.prefix < hunk.suffix:
+                            lo = 0
+                        elif hunk.suffix < hunk.prefix:
+                            hi = len(lines)
+                        footprints.setdefault(i, []).append((lo, hi))
+
+                # Keep track of the origin of each line
+                tracked = []
+                frozen  = 0
+                for hunk, pos in zip(hunks, positions):
+                    tracked.extend(origin[frozen:pos + hunk.prefix])
+                    tracked.extend([None] * (len(hunk.dstdata) - hunk.prefix - hunk.suffix))
+                    frozen = pos + len(hunk.srcdata) - hunk.suffix
+                tracked.extend(origin[frozen:])
+
+                current = result
+                origin  = tracked
+
+    return footprints
+
+def interacting_patches(indices, footprints):
+    """Split indices into groups of patchsets with overlapping or adjacent footprints."""
+    parent = dict([(i, i) for i in indices])
+
+    def _find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    end  = None
+    prev = None
+    for lo, hi, i in sorted([(lo, hi, i) for i, ranges in footprints.iteritems() for lo, hi in ranges]):
+        if end is not None and lo <= end + 1:
+            parent[_find(i)] = _find(prev)
+            end = max(end, hi)
+        else:
+            end = hi
+        prev = i
+
+    groups = collections.OrderedDict()
+    for i in indices:
+        groups.setdefault(_find(i), []).append(i)
+    return groups.values()
+
+def prefetch_wine_files(filenames):
+    """Request the content of files in the background."""
+    global _wine_blobs
+    if _wine_blobs is None:
+        _wine_blobs = _BlobServer(config.path_wine)
+    _wine_blobs.prefetch(["%s:%s" % (upstream_commit, f) for f in filenames])
+
 def get_wine_file(filename):
     """Return the content of a file."""
-    entry  = "%s:%s" % (upstream_commit, filename)
-    result = tempfile.NamedTemporaryFile()
-    try:
-        content = subprocess.check_call(["git", "show", entry], cwd=config.path_wine, \
-                                        stdout=result, stderr=_devnull)
-    except subprocess.CalledProcessError as e:
-        if e.returncode != 128: raise
-    result.flush() # shouldn't be necessary because the subprocess writes directly to the fd
-    return result
-
-def extract_patch(patchset, filename):
-    """Extract all changes to a specific file from a patchset."""
-    p = tempfile.NamedTemporaryFile()
+    global _wine_blobs
+    if _wine_blobs is None:
+        _wine_blobs = _BlobServer(config.path_wine)
+    start = time.time()
+    content = _wine_blobs.get("%s:%s" % (upstream_commit, filename))
+    _stat(("blobs", "requests"))
+    _stat(("blobs", "time"), time.time() - start)
+    _stat(("blobs", "latency", "max"), time.time() - start)
+    if content is None:
+        return patchutils.MemoryFile()
+    return patchutils.MemoryFile(content)
+
+def get_apply_cache():
+    """Return the cache of apply results, which is shared by all stages."""
+    global _apply_cache
+    if _apply_cache is None:
+        _apply_cache = _ApplyCache(config.apply_cache_limit,
+                                   config.path_cache if config.apply_cache_disk_limit > 0 else None)
+    return _apply_cache
+
+def _extract_patches(patches, filename):
+    """Extract all changes to a specific file from a list of patches."""
+    p = patchutils.MemoryFile()
     m = hashlib.sha256()
 
-    for patch in patchset.patches:
+    for patch in patches:
         if patch.modified_file != filename:
             continue
         assert not patch.is_binary
@@ -329,11 +1227,15 @@ def extract_patch(patchset, filename):
         p.write("\n")
         m.update("\n")
 
-    p.flush()
+    p.seek(0)
     return (m.digest(), p)
 
+def extract_patch(patchset, filename):
+    """Extract all changes to a specific file from a patchset."""
+    return _extract_patches(patchset.patches, filename)
+
 def select_patches(all_patches, indices, filename):
-    """Create a temporary patch file for each patchset and calculate the checksum."""
+    """Extract the changes for each patchset and calculate the checksum."""
     selected_patches = {}
     for i in indices:
         selected_patches[i] = extract_patch(all_patches[i], filename)
@@ -369,19 +1271,36 @@ def resolve_dependencies(all_patches, index = None, depends = None, auto_deps =
         _resolve(depends)
     return resolved
 
-def sync_bug_status(bugtracker, bug, url):
-    """Automatically updates the STAGED information of a referenced bug."""
+def _bug_request(task):
+    """Send a single request to the bugtracker."""
+    method, params = task
+    bugtracker = xmlrpclib.ServerProxy(config.bugtracker_url)
+    return getattr(bugtracker.Bug, method)(params)
+
+def _bug_requests(tasks):
+    """Send requests to the bugtracker, with a limited number of concurrent connections."""
+    if len(tasks) <= 1:
+        return map(_bug_request, tasks)
+    pool = multiprocessing.pool.ThreadPool(min(config.bugtracker_jobs, len(tasks)))
+    try:
+        return pool.map(_bug_request, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _bug_info(bug):
+    """Return the fields of a bug which are used by check_bug_status."""
+    return dict([(field, bug.get(field)) for field in ['id', 'summary', 'status', 'resolution',
+                                                        'cf_staged_patchset', 'cc']])
+
+def _bug_changes(bug, url):
+    """Return the changes required to update the STAGED information of a bug, or None."""
 
     # We don't want to reopen bugs
     if bug['status'] not in ["UNCONFIRMED", "NEW", "ASSIGNED", "REOPENED", "STAGED"]:
-        return
+        return None
 
-    if config.bugtracker_user is None or config.bugtracker_pass is None:
-        raise PatchUpdaterError("Can't update bug without username/password set")
-
-    changes = { 'ids'               : bug['id'],
-                'Bugzilla_login'    : config.bugtracker_user,
-                'Bugzilla_password' : config.bugtracker_pass }
+    changes = {}
 
     # Update bug status
     if bug['status'] != "STAGED":
@@ -399,28 +1318,130 @@ def sync_bug_status(bugtracker, bug, url):
     if len(missing_cc):
         changes["cc"] = {"add" : missing_cc}
 
-    bugtracker.Bug.update(changes)
+    return changes
 
-def check_bug_status(all_patches, sync_bugs=False):
-    """Checks the information in the referenced bugs and corrects them if sync_bugs is set."""
+def sync_bug_status(bugs, url_map):
+    """Automatically updates the STAGED information of referenced bugs. Bugs with the same
+    changes are updated together, returns the ids of all updated bugs."""
 
-    all_bugids = set()
-    url_map = {}
+    batches = collections.OrderedDict()
+    for bug in bugs:
+        changes = _bug_changes(bug, url_map[bug['id']])
+        if changes is not None:
+            batches.setdefault(repr(sorted(changes.items())), (changes, []))[1].append(bug['id'])
 
-    for _, patch in all_patches.iteritems():
-        url = "%s/tree/master/%s" % (config.github_url, patch.directory)
-        for sync, bugid, bugname in patch.fixes:
-            if sync and bugid is not None:
-                url_map[bugid] = url
-                all_bugids.add(bugid)
-
-    bugtracker  = xmlrpclib.ServerProxy(config.bugtracker_url)
-    bug_list    = bugtracker.Bug.get(dict(ids=list(all_bugids)))
-    staged_bugs = bugtracker.Bug.search(dict(status="STAGED"))
-
-    once = True
-    for bug in bug_list['bugs']:
-        if bug['status'] != "STAGED" or bug['cf_staged_patchset'] != url_map[bug['id']]:
+    if len(batches) == 0:
+        return []
+
+    if config.bugtracker_user is None or config.bugtracker_pass is None:
+        raise PatchUpdaterError("Can't update bug without username/password set")
+
+    tasks = []
+    for changes, bugids in batches.itervalues():
+        for chunk in _split_seq(bugids, config.bugtracker_batch_size):
+            tasks.append(("update", dict(changes, ids=chunk,
+                                         Bugzilla_login=config.bugtracker_user,
+                                         Bugzilla_password=config.bugtracker_pass)))
+    _bug_requests(tasks)
+    return [bugid for _, bugids in batches.itervalues() for bugid in bugids]
+
+class _BugStatus(object):
+    """Check the information in the referenced bugs. The bugtracker is queried in a background
+    thread, bugs which were fetched recently (or all cached bugs in offline mode) are reused."""
+
+    def __init__(self, all_patches, sync_bugs=False, offline=False):
+        self.url_map   = {}
+        self.sync_bugs = sync_bugs
+        self.offline   = offline
+        self.fetched   = {}
+        self.updated   = []
+        self.error     = None
+
+        for _, patch in all_patches.iteritems():
+            url = "%s/tree/master/%s" % (config.github_url, patch.directory)
+            for sync, bugid, bugname in patch.fixes:
+                if sync and bugid is not None:
+                    self.url_map[bugid] = url
+
+        keys = ["bug/%d" % bugid for bugid in sorted(self.url_map)] + ["search/STAGED"]
+        result_store = _ResultStore(config.path_cache)
+        try:
+            self.cached = result_store.get_bugs(keys)
+        finally:
+            result_store.close()
+
+        # Bugs are always fetched before updating them, cached information could be outdated
+        if offline:
+            self.stale = []
+        else:
+            self.stale = [key for key in keys if key not in self.cached or (sync_bugs and key.startswith("bug/")) or
+                          self.cached[key][1] < time.time() - config.bugtracker_cache_ttl]
+        hits = len([key for key in keys if key in self.cached and key not in self.stale])
+        _stat(("cache", "bugs", "hits"), hits)
+        _stat(("cache", "bugs", "misses"), len(keys) - hits)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """Fetch outdated bugs and update them if sync_bugs is set."""
+        start = time.time()
+        try:
+            bugids = [int(key[4:]) for key in self.stale if key.startswith("bug/")]
+            tasks  = [("get", dict(ids=chunk)) for chunk in _split_seq(bugids, config.bugtracker_batch_size)]
+            if "search/STAGED" in self.stale:
+                tasks.append(("search", dict(status="STAGED")))
+
+            for (method, _), result in zip(tasks, _bug_requests(tasks)):
+                if method == "get":
+                    for bug in result['bugs']:
+                        self.fetched["bug/%d" % bug['id']] = _bug_info(bug)
+                else:
+                    self.fetched["search/STAGED"] = [_bug_info(bug) for bug in result['bugs']]
+
+            if self.sync_bugs:
+                self.updated = sync_bug_status(self.attention(), self.url_map)
+        except Exception:
+            self.error = sys.exc_info()
+        _stat(("stages", "bugs", "calls"))
+        _stat(("stages", "bugs", "time"), time.time() - start)
+
+    def _get(self, key):
+        """Return a fetched or cached result, or None."""
+        if key in self.fetched:
+            return self.fetched[key]
+        if key in self.cached:
+            return self.cached[key][0]
+        return None
+
+    def attention(self):
+        """Return all referenced bugs which are not marked as STAGED with the correct URL."""
+        bugs = [self._get("bug/%d" % bugid) for bugid in sorted(self.url_map)]
+        return [bug for bug in bugs if bug is not None and
+                (bug['status'] != "STAGED" or bug['cf_staged_patchset'] != self.url_map[bug['id']])]
+
+    def report(self):
+        """Wait for the bugtracker and print all bugs which might require attention."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+        # Updated bugs have to be fetched again next time
+        entries = dict(self.fetched)
+        for bugid in self.updated:
+            entries["bug/%d" % bugid] = None
+        if len(entries):
+            result_store = _ResultStore(config.path_cache)
+            try:
+                result_store.add_bugs(entries)
+            finally:
+                result_store.close()
+
+        once = True
+        for bug in self.attention():
+            if bug['id'] in self.updated:
+                continue
             if once:
                 print ""
                 print "WARNING: The following bugs might require attention:"
@@ -428,134 +1449,416 @@ def check_bug_status(all_patches, sync_bugs=False):
                 once = False
             print " #%d - \"%s\" - %s %s - %s" % (bug['id'], bug['summary'], bug['status'],
                                                   bug['resolution'], bug['cf_staged_patchset'])
-            if sync_bugs:
-                sync_bug_status(bugtracker, bug, url_map[bug['id']])
 
-    once = True
-    for bug in staged_bugs['bugs']:
-        if bug['id'] not in all_bugids:
-            if once:
-                print ""
-                print "WARNING: The following bugs are incorrectly marked as STAGED:"
-                print ""
-                once = False
-            print " #%d - \"%s\" - %s %s" % (bug['id'], bug['summary'], bug['status'],
-                                             bug['resolution'])
+        once = True
+        for bug in sorted(self._get("search/STAGED") or [], key=lambda bug: bug['id']):
+            if bug['id'] not in self.url_map:
+                if once:
+                    print ""
+                    print "WARNING: The following bugs are incorrectly marked as STAGED:"
+                    print ""
+                    once = False
+                print " #%d - \"%s\" - %s %s" % (bug['id'], bug['summary'], bug['status'],
+                                                 bug['resolution'])
+
+        missing = [bugid for bugid in self.url_map if self._get("bug/%d" % bugid) is None]
+        if self.offline and len(missing):
+            print ""
+            print "WARNING: %d bugs were not checked, run without --offline to fetch them." % len(missing)
+
+        print ""
+
+def check_bug_status(all_patches, sync_bugs=False, offline=False):
+    """Checks the information in the referenced bugs and corrects them if sync_bugs is set."""
+    _BugStatus(all_patches, sync_bugs=sync_bugs, offline=offline).report()
 
-    print ""
+def _installed_upstream_commit():
+    """Return the upstream commit of the current patchinstall.sh script, or None."""
+    try:
+        with open(config.path_script) as fp:
+            r = re.search("^upstream_commit\\(\\)\n\\{\n\techo \"([0-9a-f]{40})\"$", fp.read(), re.MULTILINE)
+    except IOError:
+        return None
+    return r.group(1) if r else None
+
+def _add_depending(all_patches, changed):
+    """Add all patchsets which depend directly or indirectly on the given patchsets."""
+    while True:
+        depending = set([i for i, patch in all_patches.iteritems() if i not in changed and
+                         (patch.depends & changed or patch.auto_depends & changed)])
+        if len(depending) == 0:
+            break
+        changed.update(depending)
+    return changed
+
+def upstream_changes(old_commit, new_commit):
+    """Return the files which differ between two upstream commits, or None if unknown."""
+    try:
+        output = subprocess.check_output(["git", "diff", "--name-only", "-z", old_commit, new_commit],
+                                         cwd=config.path_wine, stderr=_devnull)
+    except subprocess.CalledProcessError:
+        return None
+    return set([f for f in output.split("\0") if f != ""])
+
+def rebased_patchsets(all_patches, old_commit):
+    """Determine the patchsets affected by upstream changes since a given commit, including all
+    patchsets depending on them. Returns None if all patchsets have to be checked again."""
+    files = upstream_changes(old_commit, upstream_commit)
+    if files is None:
+        return None
+    return _add_depending(all_patches, set([i for i, patch in all_patches.iteritems() if patch.modified_files & files]))
+
+def changed_patchsets(all_patches, since=None, staged=False):
+    """Determine the patchsets which were changed since a given revision or in the index, including
+    all patchsets depending on them. Returns None if all patchsets have to be checked again."""
+    try:
+        if staged:
+            files = subprocess.check_output(["git", "diff", "--cached", "--name-only"]).splitlines()
+        else:
+            files = subprocess.check_output(["git", "diff", "--name-only", since, "--"]).splitlines()
+            files += subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard",
+                                              config.path_patches]).splitlines()
+    except subprocess.CalledProcessError:
+        raise PatchUpdaterError("Failed to determine changed files")
+
+    names = set()
+    for f in files:
+        if f.startswith("staging/") and f.endswith(".py"):
+            return None # Changes to the scripts require a full check
+        tmp = f.split("/")
+        if len(tmp) == 3 and tmp[0] == config.path_patches:
+            names.add(tmp[1])
+
+    changed = set([i for i, patch in all_patches.iteritems() if patch.name in names])
+
+    # Also check patchsets affected by changes of the upstream commit
+    old_commit = _installed_upstream_commit()
+    if old_commit is None:
+        return None
+    if old_commit != upstream_commit:
+        rebased = rebased_patchsets(all_patches, old_commit)
+        if rebased is None:
+            return None
+        changed.update(rebased)
+
+    return _add_depending(all_patches, changed)
+
+def _apply_ifdef_patches(original, depends, index, selected_patches, failed):
+    """Apply the dependencies and the main patch in-process, based on the shared apply cache.
+    Returns the file before and after applying the main patch."""
+    original_hash = _sha256(original)
+    original.seek(0)
+    state = (original_hash, patchutils.split_lines(original.read()))
+
+    sections = {}
+    for j in depends + [index]:
+        selected_patches[j][1].seek(0)
+        sections[j] = patchutils.read_hunks(None, selected_patches[j][1])
+
+    apply_cache = get_apply_cache()
+    for j in depends:
+        failed.append(j)
+        state = apply_cache.apply(state[0], state[1], [(selected_patches[j][0], sections[j])], persist=True)
+
+    failed.append(index)
+    patched = apply_cache.apply(state[0], state[1], [(selected_patches[index][0], sections[index])], persist=True)
+
+    return [patchutils.MemoryFile("\n".join(lines) + "\n" if len(lines) else "") for _, lines in [state, patched]]
+
+def _generate_ifdef_patch(task):
+    """Generate the #ifdef patch for a single file, returns the patch (or None if there are
+    no changes) and the statistics."""
+    original, patched, ifdef = task
+    with _StatTimer(("ifdef", "diff")):
+        diff = patchutils.generate_ifdef_patch(patchutils.MemoryFile(original), patchutils.MemoryFile(patched), ifdef=ifdef)
+        if diff is not None:
+            try:
+                content = diff.read()
+            finally:
+                diff.close()
+        else:
+            content = None
+    return content, _stat_take()
+
+def generate_ifdefined(all_patches, skip_checks=False, changed=None, jobs=None, selection=None):
+    """Update autogenerated ifdefined patches, which can be used to selectively disable features at compile time.
+    If a selection of patchsets is given, their existing patches are used without updating them."""
+    ifdef_patches = {}
+    pending       = []
 
-def generate_ifdefined(all_patches, skip_checks=False):
-    """Update autogenerated ifdefined patches, which can be used to selectively disable features at compile time."""
     for i, patch in all_patches.iteritems():
         if patch.ifdefined is None:
             continue
         if patch.disabled:
             continue
+        if selection is not None and i not in selection:
+            continue
 
         filename = os.path.join(patch.directory, config.path_IfDefined)
-        headers = { 'author': "Wine Staging Team",
-                    'email': "webmaster@fds-team.de",
-                    'subject': "Autogenerated #ifdef patch for %s." % patch.name }
 
         if skip_checks:
             patch.files = [os.path.basename(filename)]
             continue
 
-        with open(filename, "wb") as fp:
-            fp.write("From: %s <%s>\n" % (headers['author'], headers['email']))
-            fp.write("Subject: %s\n" % headers['subject'])
-            fp.write("\n")
-            fp.write("Based on patches by:\n")
-            for author, email in sorted(set([(p.patch_author, p.patch_email) for p in patch.patches])):
-                fp.write("    %s <%s>\n" % (author, email))
-            fp.write("\n")
+        # Unchanged patchsets can reuse the existing file, a selection never updates it
+        if selection is not None and not os.path.isfile(filename):
+            raise PatchUpdaterError("Autogenerated patch %s doesn't exist" % filename)
+        elif selection is None and (changed is None or i in changed or not os.path.isfile(filename)):
+            pending.append(i)
+        else:
+            ifdef_patches[i] = list(patchutils.read_patch(filename))
+
+    # Patchsets are based on the #ifdef patches of earlier dependencies, so they have to be
+    # generated in waves. Everything within a wave is independent and can run in parallel.
+    depends = {}
+    waves   = {}
+    for i in pending:
+        depends[i] = resolve_dependencies(all_patches, i)
+        waves[i]   = max([waves[j] + 1 for j in depends[i] if j < i and waves.has_key(j)] + [0])
+
+    result_store = _ResultStore(config.path_cache)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    pool = None
+    try:
+        for wave in xrange(max(waves.values()) + 1 if len(waves) else 0):
+            current = [i for i in pending if waves[i] == wave]
+            outputs = {}
+            tasks   = []
+
+            for i in current:
+                patch = all_patches[i]
+                for f in sorted(patch.modified_files):
+
+                    # Select the changes of the dependencies, based on the #ifdef patches of earlier patchsets
+                    original = get_wine_file(f)
+                    selected_patches = {}
+                    for j in depends[i] + [i]:
+                        if j < i and ifdef_patches.has_key(j):
+                            selected_patches[j] = _extract_patches(ifdef_patches[j], f)
+                        else:
+                            selected_patches[j] = extract_patch(all_patches[j], f)
+
+                    # Generated patches are identified by the hashes of all inputs
+                    # and the version of the algorithm
+                    m = hashlib.sha256()
+                    m.update("V%d" % patchutils.IFDEF_VERSION)
+                    m.update(_sha256(original))
+                    for j in depends[i]:
+                        m.update("D%s" % selected_patches[j][0])
+                    m.update("P%s" % selected_patches[i][0])
+                    m.update("I%s" % patch.ifdefined)
+                    unique_hash = m.digest()
+
+                    diff = result_store.get_ifdef(unique_hash)
+                    if diff is not None:
+                        _stat(("cache", "ifdef", "hits"))
+                        outputs[(i, f)] = diff
+                        continue
+                    _stat(("cache", "ifdef", "misses"))
 
-            depends = resolve_dependencies(all_patches, i)
-            for f in sorted(patch.modified_files):
+                    # Reconstruct the state after applying the dependencies and the main patch
+                    failed = []
+                    try:
+                        try:
+                            original, patched = _apply_ifdef_patches(original, depends[i], i, selected_patches, failed)
+                        except patchutils.PatchUnsupportedError:
+                            del failed[:]
+                            for j in depends[i]:
+                                failed.append(j)
+                                with _StatTimer(("patch",)):
+                                    original = patchutils.apply_patch(original, selected_patches[j][1], fuzz=0)
+                            failed.append(i)
+                            with _StatTimer(("patch",)):
+                                patched = patchutils.apply_patch(original, selected_patches[i][1], fuzz=0)
+                    except patchutils.PatchApplyError:
+                        raise PatchUpdaterError("Changes to file %s don't apply: %s" %
+                                                (f, ", ".join([all_patches[j].name for j in failed])))
 
-                # Reconstruct the state after applying the dependencies
-                original = get_wine_file(f)
-                selected_patches = select_patches(all_patches, depends, f)
-                failed = []
+                    tasks.append(((i, f, unique_hash), (original.getvalue(), patched.getvalue(), patch.ifdefined)))
 
+            # Now get the diff between both, in parallel if required
+            if jobs > 1 and len(tasks) > 1:
+                if pool is None:
+                    pool = multiprocessing.Pool(processes=jobs, initializer=_worker_init)
+                results = pool.imap(_generate_ifdef_patch, [task for _, task in tasks])
+            else:
+                results = itertools.imap(_generate_ifdef_patch, [task for _, task in tasks])
+
+            for (i, f, unique_hash), (diff, task_stats) in itertools.izip([key for key, _ in tasks], results):
+                _stat_merge(task_stats)
+                outputs[(i, f)] = diff if diff is not None else ""
+                result_store.add_ifdef(unique_hash, outputs[(i, f)])
+
+            # Assemble the patches, files are only rewritten if something has changed
+            for i in current:
+                patch = all_patches[i]
+                filename = os.path.join(patch.directory, config.path_IfDefined)
+
+                lines = []
+                lines.append("From: Wine Staging Team <webmaster@fds-team.de>\n")
+                lines.append("Subject: Autogenerated #ifdef patch for %s.\n" % patch.name)
+                lines.append("\n")
+                lines.append("Based on patches by:\n")
+                for author, email in sorted(set([(p.patch_author, p.patch_email) for p in patch.patches])):
+                    lines.append("    %s <%s>\n" % (author, email))
+                lines.append("\n")
+
+                for f in sorted(patch.modified_files):
+                    if outputs[(i, f)] != "":
+                        lines.append("diff --git a/%s b/%s\n" % (f, f))
+                        lines.append("--- a/%s\n" % f)
+                        lines.append("+++ b/%s\n" % f)
+                        lines.append(outputs[(i, f)])
+
+                content = "".join(lines)
                 try:
-                    for j in depends:
-                        failed.append(j)
-                        original = patchutils.apply_patch(original, selected_patches[j][1], fuzz=0)
-                except patchutils.PatchApplyError:
-                    raise PatchUpdaterError("Changes to file %s don't apply: %s" %
-                                            (f, ", ".join([all_patches[j].name for j in failed])))
+                    with open(filename, "rb") as fp:
+                        unchanged = (fp.read() == content)
+                except IOError:
+                    unchanged = False
 
-                # Now apply the main patch
-                p = extract_patch(patch, f)[1]
+                if not unchanged:
+                    with open(filename, "wb") as fp:
+                        fp.write(content)
 
-                try:
-                    failed.append(i)
-                    patched = patchutils.apply_patch(original, p, fuzz=0)
-                except patchutils.PatchApplyError:
-                    raise PatchUpdaterError("Changes to file %s don't apply: %s" %
-                                            (f, ", ".join([all_patches[j].name for j in failed])))
-
-                # Now get the diff between both
-                diff = patchutils.generate_ifdef_patch(original, patched, ifdef=patch.ifdefined)
-                if diff is not None:
-                    fp.write("diff --git a/%s b/%s\n" % (f, f))
-                    fp.write("--- a/%s\n" % f)
-                    fp.write("+++ b/%s\n" % f)
-                    while True:
-                        buf = diff.read(16384)
-                        if buf == "": break
-                        fp.write(buf)
-                    diff.close()
-
-            # Close the file
-            fp.close()
-
-        # Add changes to git
-        subprocess.call(["git", "add", filename])
-
-        # Add the autogenerated file as a last patch
-        patch.files = [os.path.basename(filename)]
+                    # Add changes to git
+                    subprocess.call(["git", "add", filename])
+
+                ifdef_patches[i] = list(patchutils.read_patch(filename))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        result_store.close()
+
+    # Add the autogenerated file as a last patch
+    for i, ifdef_patch in ifdef_patches.iteritems():
+        patch = all_patches[i]
+        patch.files = [config.path_IfDefined]
         for p in patch.patches:
             p.filename      = None
             p.modified_file = None
-        for p in patchutils.read_patch(filename):
+        for p in ifdef_patch:
             assert p.modified_file in patch.modified_files
             p.patch_author  = None
             patch.patches.append(p)
 
-def generate_apply_order(all_patches, skip_checks=False):
+    # Store the apply results for the next run
+    if _apply_cache is not None:
+        _apply_cache.close()
+
+def generate_apply_order(all_patches, skip_checks=False, jobs=None, changed=None, selection=None):
     """Resolve dependencies, and afterwards check if everything applies properly."""
+    resolved = resolve_apply_order(all_patches, selection=selection)
+    if not skip_checks:
+        verify_apply_order(all_patches, resolved, jobs=jobs, changed=changed,
+                           partial=selection is not None)
+    return resolved
+
+def select_patchsets(all_patches, select=None, exclude=None):
+    """Return the patchsets enabled by a selection of patchset names (or all enabled patchsets)
+    and their dependencies without the excluded patchsets. Like in patchinstall.sh, no enabled
+    patchset may depend on an excluded patchset."""
+    name_to_id = dict([(patch.name, i) for i, patch in all_patches.iteritems()])
+
+    def _lookup(names):
+        for name in names:
+            if not name_to_id.has_key(name):
+                raise PatchUpdaterError("Unknown patchset %s" % name)
+        return [name_to_id[name] for name in names]
+
+    if select is None:
+        selected = sorted([i for i, patch in all_patches.iteritems() if not patch.disabled])
+    else:
+        selected = _lookup(select)
+        for i in selected:
+            if all_patches[i].disabled:
+                raise PatchUpdaterError("Selected patchset %s is disabled" % all_patches[i].name)
+
+    # Only explicit dependencies are enabled automatically, like in patchinstall.sh
+    resolved = resolve_dependencies(all_patches, depends=selected, auto_deps=False)
+
+    excluded = set(_lookup(exclude or []))
+    for i in resolved:
+        if i in excluded:
+            if select is not None and i in selected:
+                raise PatchUpdaterError("Selected patchset %s is excluded" % all_patches[i].name)
+            continue
+        for j in sorted(all_patches[i].depends):
+            if j in excluded:
+                raise PatchUpdaterError("Patchset %s disabled, but %s depends on that" %
+                                        (all_patches[j].name, all_patches[i].name))
+
+    return set([i for i in resolved if i not in excluded])
+
+def resolve_apply_order(all_patches, selection=None):
+    """Resolve dependencies of all enabled patchsets. The result can be limited to a selection
+    of patchsets (see select_patchsets), the order is the same as for all patchsets."""
     depends     = sorted([i for i, patch in all_patches.iteritems() if not patch.disabled])
     resolved    = resolve_dependencies(all_patches, depends=depends)
-    max_patches = max(resolved) + 1
 
-    if skip_checks:
-        return resolved
+    # Precompute the transitive dependencies of each patchset as a bitset, patchsets are
+    # resolved in order, so the bitsets of all dependencies are already known.
+    for i, patch in [(i, all_patches[i]) for i in resolved]:
+        patch.verify_depends = 0
+        for j in patch.depends:
+            patch.verify_depends |= all_patches[j].verify_depends | (1 << j)
+
+    if selection is not None:
+        resolved = [i for i in resolved if i in selection]
+    return resolved
+
+def ifdefined_files(all_patches):
+    """Return the set of files which are modified by IfDefined patchsets."""
+    return set([f for patch in all_patches.itervalues() if patch.ifdefined is not None and not patch.disabled
+                for f in patch.modified_files])
+
+def verify_apply_order(all_patches, resolved, jobs=None, changed=None, include=None, exclude=None, deadline=None,
+                       partial=False):
+    """Check if all combinations of patches apply properly. The check can be limited to the files
+    in include, files in exclude are skipped. Combinations which are not checked before the deadline
+    are skipped and verified first in the next run, returns the skipped files and combinations.
+    If partial is set, resolved only contains a selection of the patchsets, files skipped in previous
+    runs are still verified in the next full run."""
 
-    # Generate timestamps based on dependencies, still required for binary patches
     # Find out which files are modified by multiple patches
     modified_files = {}
     for i, patch in [(i, all_patches[i]) for i in resolved]:
-        patch.verify_time = [0]*max_patches
-        patch.verify_time[i] += 1
-        for j in patch.depends:
-            patch.verify_time = causal_time_combine(patch.verify_time, all_patches[j].verify_time)
-
         for f in patch.modified_files:
+            if include is not None and f not in include:
+                continue
+            if exclude is not None and f in exclude:
+                continue
             if f not in modified_files:
                 modified_files[f] = []
             modified_files[f].append(i)
 
     # Check dependencies
-    dependency_cache = _load_dict(config.path_cache)
-    pool = multiprocessing.pool.ThreadPool(processes=4)
+    result_store = _ResultStore(config.path_cache)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    verify_jobs = []
+    tempfiles   = []
+    chunk_size  = config.verify_chunk_size
+    pool        = None
+    skipped     = {}
     try:
+        # Files which were skipped in previous runs have to be verified, even if they didn't change
+        pending = result_store.get_skipped()
+
         for filename, indices in modified_files.iteritems():
+            job = _VerifyJob(filename, indices)
+
+            # Only verify files which are modified by changed patchsets
+            if changed is not None and not any([i in changed for i in indices]) and filename not in pending:
+                continue
 
             # If one of patches is a binary patch, then we cannot / won't verify it - require dependencies in this case
             if contains_binary_patch(all_patches, indices, filename):
-                if not causal_time_relation_any(all_patches, indices):
+                if not dependency_relation_any(all_patches, indices):
                     raise PatchUpdaterError("Because of binary patch modifying file %s the following patches need explicit dependencies: %s" %
                                             (filename, ", ".join([all_patches[i].name for i in indices])))
                 continue
@@ -572,82 +1875,146 @@ def generate_apply_order(all_patches, skip_checks=False):
             for i in indices:
                 m.update("P%s" % selected_patches[i][0])
                 for j in indices:
-                    if causal_time_smaller(all_patches[j].verify_time, all_patches[i].verify_time):
+                    if depends_on(all_patches, i, j):
                         m.update("D%s" % selected_patches[j][0])
-            unique_hash = m.digest()
+            job.unique_hash = m.digest()
 
             # Skip checks if it matches the information from the cache
-            # For backwards compatibility, convert string entries to list
-            if dependency_cache.has_key(filename):
-                if not isinstance(dependency_cache[filename], list):
-                    dependency_cache[filename] = [dependency_cache[filename]]
-                if unique_hash in dependency_cache[filename]:
-                    dependency_cache[filename].append(unique_hash)
-                    dependency_cache[filename].remove(unique_hash)
-                    continue
+            if result_store.has_file(filename, job.unique_hash):
+                _stat(("cache", "files", "hits"))
+                if filename in pending and not partial:
+                    result_store.add_skipped(filename, None)
+                continue
+            _stat(("cache", "files", "misses"))
 
-            chunk_size = 20
-            iterables = []
-            total = 0
-            for i in xrange(1, len(indices) + 1):
-                # HACK: It is no longer feasible to check all combinations for configure.ac.
-                # Only check corner cases (applying individual patches and applying all patches).
-                if filename == "configure.ac" and i > 4 and i <= len(indices) - 4: continue
-                iterables.append(itertools.combinations(indices, i))
-                total += _binomial(len(indices), i)
+            # Otherwise only check the combinations which weren't verified before
+            job.original_hash = original_hash
+            job.digests  = dict([(i, selected_patches[i][0]) for i in indices])
+            job.verified = result_store.get_subsets(filename)
 
+            for i in indices:
+                job.depends[i] = all_patches[i].verify_depends & _mask(indices)
+
+            # Parse the patches once, to apply them in-process and share intermediate states
+            try:
+                original_content.seek(0)
+                job.original_lines = patchutils.split_lines(original_content.read())
+                job.sections = {}
+                for i in indices:
+                    selected_patches[i][1].seek(0)
+                    job.sections[i] = patchutils.read_hunks(None, selected_patches[i][1])
+            except patchutils.PatchUnsupportedError:
+                job.sections = None
+
+            # Patchsets which don't touch neighbouring lines cannot influence each other,
+            # it is sufficient to check all combinations within each group of interacting
+            # patchsets (including their dependencies), and finally applying all patches.
+            if job.sections is not None:
+                try:
+                    footprints = patch_footprints(all_patches, indices, job.original_lines, job.sections)
+                    if footprints is not None:
+                        job.groups = interacting_patches(indices, footprints)
+                except (patchutils.PatchUnsupportedError, patchutils.PatchApplyError):
+                    pass
+
+            # Temporary files are only required when the patches can't be applied in-process
+            if job.sections is None:
+                job.original = original_content.name
+                job.patches  = dict([(i, selected_patches[i][1].name) for i in indices])
+                tempfiles.append((original_content, selected_patches))
+
+            job.masks = [_mask(group) for group in job.groups]
+            for group in job.groups:
+                job.total += (1 << len(group)) - 1
+            if len(job.groups) > 1:
+                job.total += 1
+            verify_jobs.append(job)
+
+        # Estimate the cost of each file based on the time per combination in previous runs,
+        # or the average of all files if unknown.
+        costs = result_store.get_costs()
+        total_seconds      = sum([seconds for seconds, _ in costs.itervalues()])
+        total_combinations = sum([combinations for _, combinations in costs.itervalues()])
+        average = total_seconds / total_combinations if total_combinations > 0 else config.verify_default_cost
+        for job in verify_jobs:
+            seconds, combinations = costs.get(job.filename, (average, 1))
+            job.cost = job.total * seconds / combinations
+
+        # Resume files which were skipped before, afterwards start with the most expensive
+        # files, so that the workers are busy until the end
+        verify_jobs.sort(key=lambda job: (job.filename not in pending, -job.cost))
+        if changed is not None:
+            print ""
+            print "Verifying %d files, %d patch combinations" % (len(verify_jobs), sum([job.total for job in verify_jobs]))
+            for job in verify_jobs[:5]:
+                print " %s - %d patch combinations" % (job.filename, job.total)
+            print ""
+
+        def _tasks():
+            for k, job in enumerate(verify_jobs):
+                iterables = []
+                for g, group in enumerate(job.groups):
+                    for i in xrange(1, len(group) + 1):
+                        iterables.append(itertools.izip(itertools.repeat(g), itertools.combinations(group, i)))
+                if len(job.groups) > 1:
+                    iterables.append([(0, tuple(job.indices))])
+                for chunk in _split_seq(itertools.chain(*iterables), chunk_size):
+                    yield (k, chunk)
+
+        # Check the combinations of all files in a shared pool, results are processed in order.
+        # Workers inherit the apply cache, which already contains the results of previous stages.
+        if jobs > 1 and len(verify_jobs):
+            with get_apply_cache().lock:
+                pool = multiprocessing.Pool(processes=jobs, initializer=_verify_init,
+                                            initargs=(verify_jobs, config.apply_cache_limit // jobs, deadline))
+            results = pool.imap(_verify_chunk, _tasks())
+        else:
+            _verify_init(verify_jobs, config.apply_cache_limit, deadline, worker=False)
+            results = itertools.imap(_verify_chunk, _tasks())
+
+        for job in verify_jobs:
             # Show a progress bar while applying the patches - this task might take some time
-            with progressbar.ProgressBar(desc=filename, total=total / chunk_size) as progress:
-
-                def test_apply(current):
-                    set_apply = [(i, all_patches[i]) for i in current]
-                    set_skip  = [(i, all_patches[i]) for i in indices if i not in current]
-
-                    # Check if there is any patch2 which depends directly or indirectly on patch1.
-                    # If this is the case we found an impossible situation, we can be skipped in this test.
-                    for i, patch1 in set_apply:
-                        for j, patch2 in set_skip:
-                            if causal_time_smaller(patch2.verify_time, patch1.verify_time):
-                                return True # we can skip this test
-
-                    try:
-                        original = original_content
-                        for i, _ in set_apply:
-                            original = patchutils.apply_patch(original, selected_patches[i][1], fuzz=0)
-                    except patchutils.PatchApplyError:
-                        return False
-
-                    return True # everything is fine
-
-                def test_apply_seq(current_list):
-                    for current in current_list:
-                        if not test_apply(current):
-                            return current
-                    return None
-
-                it = _split_seq(itertools.chain(*iterables), chunk_size)
-                for k, failed in enumerate(pool.imap_unordered(test_apply_seq, it)):
+            seconds = 0.0
+            applied = 0
+            with progressbar.ProgressBar(desc=job.filename, total=job.total / chunk_size) as progress:
+                for k in xrange((job.total + chunk_size - 1) // chunk_size):
+                    failed, verified, elapsed, task_stats = next(results)
+                    _stat_merge(task_stats)
+                    if verified is None:
+                        skipped[job.filename] = skipped.get(job.filename, 0) + \
+                                                min(chunk_size, job.total - k * chunk_size)
+                        continue
+                    result_store.add_subsets(job.filename, verified)
+                    seconds += elapsed
+                    applied += len(verified)
                     if failed is not None:
                         progress.finish("<failed to apply>")
                         raise PatchUpdaterError("Changes to file %s don't apply: %s" %
-                                                (filename, ", ".join([all_patches[i].name for i in failed])))
+                                                (job.filename, ", ".join([all_patches[i].name for i in failed])))
                     progress.update(k)
-
-            # Update the dependency cache, store max 10 entries per file
-            if not dependency_cache.has_key(filename):
-                dependency_cache[filename] = []
-            dependency_cache[filename].append(unique_hash)
-            dependency_cache[filename] = dependency_cache[filename][-10:]
-
-        # Delete outdated cache information
-        for filename in dependency_cache.keys():
-            if not modified_files.has_key(filename):
-                del dependency_cache[filename]
+                if job.filename in skipped:
+                    progress.finish("<time budget exceeded>")
+
+            _stat(("files", job.filename, "combinations"), job.total)
+            if applied > 0:
+                result_store.add_cost(job.filename, seconds, applied)
+
+            # Update the dependency cache, skipped combinations are checked in the next run
+            if job.filename in skipped:
+                _stat(("budget", "skipped_files"))
+                _stat(("budget", "skipped_combinations"), skipped[job.filename])
+                result_store.add_skipped(job.filename, skipped[job.filename])
+            else:
+                result_store.add_file(job.filename, job.unique_hash)
+                if not partial:
+                    result_store.add_skipped(job.filename, None)
     finally:
-        pool.close()
-        _save_dict(config.path_cache, dependency_cache)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        result_store.close()
 
-    return resolved
+    return skipped
 
 def generate_script(all_patches, resolved):
     """Generate script to apply patches."""
@@ -759,10 +2126,44 @@ if __name__ == "__main__":
             raise argparse.ArgumentTypeError("not a valid commit hash")
         return commit
 
+    def _check_jobs(jobs):
+        if not re.match("^[0-9]+$", jobs) or int(jobs) < 1:
+            raise argparse.ArgumentTypeError("not a valid number of jobs")
+        return int(jobs)
+
+    def _patchset_names(values):
+        if values is None:
+            return None
+        return [name for value in values for name in value.split(",") if name != ""]
+
+    def _check_seconds(seconds):
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            seconds = 0
+        if seconds <= 0:
+            raise argparse.ArgumentTypeError("not a valid number of seconds")
+        return seconds
+
     parser = argparse.ArgumentParser(description="Automatic patch dependency checker and apply script generator.")
     parser.add_argument('--skip-checks', action='store_true', help="Skip dependency checks")
     parser.add_argument('--commit', type=_check_commit_hash, help="Use given commit hash instead of HEAD")
-    parser.add_argument('--sync-bugs', action='store_true', help="Update bugs in bugtracker (requires admin rights)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sync-bugs', action='store_true', help="Update bugs in bugtracker (requires admin rights)")
+    group.add_argument('--offline', action='store_true', help="Only use cached information from the bugtracker")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--changed-since', metavar="REV", help="Only check patchsets changed since the given revision")
+    group.add_argument('--staged', action='store_true', help="Only check patchsets with changes in the git index")
+    group.add_argument('--rebase', action='store_true', help="Only check patchsets affected by upstream changes")
+    parser.add_argument('--select', action='append', metavar="PATCHSETS",
+                        help="Only verify the given patchsets (comma separated) and their dependencies")
+    parser.add_argument('--exclude', action='append', metavar="PATCHSETS",
+                        help="Don't verify the given patchsets (comma separated)")
+    parser.add_argument('--jobs', type=_check_jobs, default=multiprocessing.cpu_count(), help="Number of parallel jobs")
+    parser.add_argument('--profile', action='store_true', help="Show where the time was spent")
+    parser.add_argument('--stats-json', metavar="FILE", help="Write statistics in JSON format to a file")
+    parser.add_argument('--time-budget', type=_check_seconds, metavar="SECONDS",
+                        help="Skip remaining dependency checks after the given time, they are resumed in the next run")
     args = parser.parse_args()
 
     tools_directory = os.path.dirname(os.path.realpath(__file__))
@@ -779,19 +2180,100 @@ if __name__ == "__main__":
         config.bugtracker_pass = None
 
     try:
-        upstream_commit = _upstream_commit(args.commit)
-        all_patches = load_patchsets()
+        config.bugtracker_url = config_parser.get('bugtracker', 'url')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
 
-        # Check bugzilla
-        check_bug_status(all_patches, sync_bugs=args.sync_bugs)
+    if args.profile or args.stats_json is not None:
+        _stats = _Stats()
 
-        # Update autogenerated files
-        generate_ifdefined(all_patches, skip_checks=args.skip_checks)
-        resolved = generate_apply_order(all_patches, skip_checks=args.skip_checks)
-        generate_script(all_patches, resolved)
+    try:
+        start = time.time()
+        deadline = start + args.time_budget if args.time_budget is not None else None
+        upstream_commit = _upstream_commit(args.commit)
+        with _StatTimer(("stages", "load")):
+            all_patches = load_patchsets(jobs=args.jobs)
+
+        # Determine changed patchsets in incremental mode
+        changed = None
+        if args.changed_since is not None or args.staged:
+            changed = changed_patchsets(all_patches, since=args.changed_since, staged=args.staged)
+        elif args.rebase:
+            old_commit = _installed_upstream_commit()
+            if old_commit is not None:
+                changed = rebased_patchsets(all_patches, old_commit)
+
+        # Limit the checks to the patchsets enabled in a downstream build
+        selection = None
+        if args.select is not None or args.exclude is not None:
+            selection = select_patchsets(all_patches, select=_patchset_names(args.select),
+                                         exclude=_patchset_names(args.exclude))
+            print ""
+            print "Verifying %d of %d enabled patchsets, %s and the #ifdef patches are not updated" % \
+                  (len(selection), len([p for p in all_patches.itervalues() if not p.disabled]), config.path_script)
+
+        # Check bugzilla in the background
+        bug_status = _BugStatus(all_patches, sync_bugs=args.sync_bugs, offline=args.offline)
+
+        # Update autogenerated files. Files which are not modified by IfDefined patchsets are
+        # verified while the #ifdef patches are generated.
+        get_apply_cache()
+        ifdef_files = ifdefined_files(all_patches)
+        scheduler = _Scheduler()
+        scheduler.add("ifdef", lambda: generate_ifdefined(all_patches, skip_checks=args.skip_checks,
+                                                           changed=changed, jobs=args.jobs,
+                                                           selection=selection))
+        scheduler.add("resolve", lambda: resolve_apply_order(all_patches, selection=selection))
+        if not args.skip_checks:
+            scheduler.add("verify", lambda resolved: verify_apply_order(all_patches, resolved, jobs=args.jobs,
+                                                                          changed=changed, exclude=ifdef_files,
+                                                                          deadline=deadline,
+                                                                          partial=selection is not None),
+                          requires=["resolve"])
+            scheduler.add("verify-ifdef", lambda resolved, *_: verify_apply_order(all_patches, resolved, jobs=args.jobs,
+                                                                                   changed=changed, include=ifdef_files,
+                                                                                   deadline=deadline,
+                                                                                   partial=selection is not None),
+                          requires=["resolve", "ifdef", "verify"])
+        if selection is None:
+            scheduler.add("script", lambda resolved, *_: generate_script(all_patches, resolved),
+                          requires=["resolve", "ifdef"] + ([] if args.skip_checks else ["verify-ifdef"]))
+        results = scheduler.run()
+
+        # Report checks which were skipped because of the time budget
+        skipped = {}
+        for name in ["verify", "verify-ifdef"]:
+            skipped.update(results.get(name) or {})
+        if len(skipped):
+            print ""
+            print "WARNING: Time budget exceeded, the following files were not fully verified:"
+            print ""
+            for filename, combinations in sorted(skipped.iteritems()):
+                print " %s - %d patch combinations" % (filename, combinations)
+            print ""
+            print "The remaining patch combinations will be verified first in the next run."
+
+        bug_status.report()
+        _stat(("total", "time"), time.time() - start)
 
     except PatchUpdaterError as e:
         print ""
         print "ERROR: %s" % e
         print ""
         exit(1)
+
+    if _stats is not None:
+        stats = _stats.report()
+
+        if args.profile:
+            print "Profile:"
+            print ""
+            for key, value in sorted(_stats.take().iteritems()):
+                print " %-60s %s" % ("/".join(key), ("%.3f" % value) if isinstance(value, float) else value)
+            print ""
+
+        if args.stats_json is not None:
+            with open(args.stats_json, "w") as fp:
+                json.dump({'version': 1, 'time': int(time.time()), 'upstream_commit': upstream_commit,
+                           'stats': stats}, fp, indent=2, sort_keys=True)
+                fp.write("\n")
@@ -0,0 +1,280 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# Tests for the automatic patch dependency checker.
+#
+# Copyright (C) 2017 Wine Staging Team
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+from patchupdate import config, PatchSet, PatchUpdaterError, check_bug_status, patch_footprints, \
+                        interacting_patches, select_patchsets
+import os
+import patchutils
+import shutil
+import SimpleXMLRPCServer
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+if __name__ == "__main__":
+
+    def _patchsets(count):
+        all_patches = {}
+        for i in xrange(count):
+            all_patches[i] = PatchSet("patchset%d" % i, "patches/patchset%d" % i)
+        return all_patches
+
+    def _sections(lines):
+        return patchutils.read_hunks(None, StringIO("\n".join(lines + [""])))
+
+    # Tests for patch_footprints() and interacting_patches()
+    class FootprintTests(unittest.TestCase):
+        def test_unique(self):
+            original = ["line%d" % i for i in xrange(1, 31)]
+            sections = {}
+            sections[0] = _sections(["@@ -2,7 +2,7 @@",
+                                     " line2", " line3", " line4",
+                                     "-line5", "+changed5",
+                                     " line6", " line7", " line8"])
+            sections[1] = _sections(["@@ -20,7 +20,7 @@",
+                                     " line20", " line21", " line22",
+                                     "-line23", "+changed23",
+                                     " line24", " line25", " line26"])
+            sections[2] = _sections(["@@ -6,6 +6,7 @@",
+                                     " line6", " line7", " line8",
+                                     "+added",
+                                     " line9", " line10", " line11"])
+
+            all_patches = _patchsets(3)
+            footprints = patch_footprints(all_patches, [0, 1, 2], original, sections)
+            self.assertEqual(interacting_patches([0, 1, 2], footprints), [[0, 2], [1]])
+
+        def test_repeated_context(self):
+            original = ["b", "c", "b", "c", "b", "a", "a", "b", "c", "b", "a", "a", "a", "b", "a", "b", "b",
+                        "b", "b", "b", "a", "b", "a", "a", "a", "c", "a", "a", "a", "b", "c", "a", "c", "a", "b"]
+            sections = {}
+            sections[0] = _sections(["@@ -2,6 +2,4 @@", " c", " b", "-c", "-b", " a", " a"])
+            sections[1] = _sections(["@@ -1,3 +1,6 @@", "+a", "+a", "+a", " b", " c", " b"])
+            sections[2] = _sections(["@@ -13,4 +13,7 @@", " a", " b", "+b", "+b", "+b", " a", " b"])
+            sections[3] = _sections(["@@ -31,2 +31,5 @@", " c", "+b", "+b", "+c", " a"])
+            sections[4] = _sections(["@@ -32,4 +32,8 @@", " a", " c", " a", "+a", "+a", "+c", "+b", " b"])
+
+            # Only the combination of patchsets 0, 3 and 4 fails, the position of the hunks
+            # depends on other patchsets, so they cannot be split into independent groups.
+            def _apply(indices):
+                lines = original
+                for i in indices:
+                    lines = patchutils.apply_sections(lines, sections[i])
+            for indices in [[0], [3], [4], [0, 3], [0, 4], [3, 4], [0, 1, 2, 3, 4]]:
+                _apply(indices)
+            self.assertRaises(patchutils.PatchApplyError, _apply, [0, 3, 4])
+
+            all_patches = _patchsets(5)
+            self.assertEqual(patch_footprints(all_patches, range(5), original, sections), None)
+
+        def test_created_match(self):
+            original = ["line%d" % i for i in xrange(1, 21)]
+            sections = {}
+            sections[0] = _sections(["@@ -2,7 +2,13 @@",
+                                     " line2", " line3", " line4",
+                                     "+line13", "+line14", "+line15", "+line16", "+line17", "+line18", "+line19",
+                                     "-line5",
+                                     " line6", " line7", " line8"])
+            sections[1] = _sections(["@@ -13,7 +13,7 @@",
+                                     " line13", " line14", " line15",
+                                     "-line16", "+changed16",
+                                     " line17", " line18", " line19"])
+
+            # Patchset 0 adds another copy of the lines patchset 1 depends on
+            all_patches = _patchsets(2)
+            self.assertEqual(patch_footprints(all_patches, [0, 1], original, sections), None)
+
+    # Tests for select_patchsets()
+    class SelectionTests(unittest.TestCase):
+        def setUp(self):
+            self.all_patches = _patchsets(4)
+            self.all_patches[1].depends.add(0)
+            self.all_patches[2].depends.add(1)
+
+        def test_select(self):
+            self.assertEqual(select_patchsets(self.all_patches), set([0, 1, 2, 3]))
+            self.assertEqual(select_patchsets(self.all_patches, select=["patchset2"]), set([0, 1, 2]))
+            self.assertRaises(PatchUpdaterError, select_patchsets, self.all_patches, select=["unknown"])
+
+        def test_exclude(self):
+            self.assertEqual(select_patchsets(self.all_patches, exclude=["patchset3"]), set([0, 1, 2]))
+            self.assertEqual(select_patchsets(self.all_patches, select=["patchset3"], exclude=["patchset0"]), set([3]))
+
+            # Like patchinstall.sh, enabled patchsets must not depend on excluded patchsets
+            self.assertRaises(PatchUpdaterError, select_patchsets, self.all_patches, exclude=["patchset1"])
+            self.assertRaises(PatchUpdaterError, select_patchsets, self.all_patches,
+                              select=["patchset2"], exclude=["patchset0"])
+            self.assertRaises(PatchUpdaterError, select_patchsets, self.all_patches,
+                              select=["patchset3"], exclude=["patchset3"])
+
+    # Local stand-in for the XML-RPC interface of the bugtracker
+    class _BugServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+        daemon_threads = True
+
+    class _BugInterface(object):
+        def __init__(self, bugs):
+            self.bugs     = bugs
+            self.requests = []
+            self.active   = 0
+            self.parallel = 0
+            self.lock     = threading.Lock()
+
+        def _request(self, method, params):
+            with self.lock:
+                self.requests.append((method, params))
+                self.active += 1
+                self.parallel = max(self.parallel, self.active)
+            time.sleep(0.05)
+            with self.lock:
+                self.active -= 1
+
+        def get(self, params):
+            self._request("get", params)
+            return {'bugs': [self.bugs[bugid] for bugid in params['ids'] if bugid in self.bugs]}
+
+        def search(self, params):
+            self._request("search", params)
+            return {'bugs': [bug for bug in self.bugs.itervalues() if bug['status'] == params['status']]}
+
+        def update(self, params):
+            self._request("update", params)
+            for bugid in params['ids']:
+                bug = self.bugs[bugid]
+                if 'status' in params:
+                    bug['status'] = params['status']
+                if 'cf_staged_patchset' in params:
+                    bug['cf_staged_patchset'] = params['cf_staged_patchset']
+                if 'cc' in params:
+                    bug['cc'] += params['cc']['add']
+            return {'bugs': []}
+
+    # Tests for the bugtracker synchronization
+    class BugStatusTests(unittest.TestCase):
+        def setUp(self):
+            self.bugs = {}
+            for bugid in xrange(1, 11):
+                self.bugs[bugid] = {'id': bugid, 'summary': "Bug %d" % bugid, 'status': "NEW",
+                                    'resolution': "", 'cf_staged_patchset': "", 'cc': []}
+            self.interface = _BugInterface(self.bugs)
+
+            self.server = _BugServer(("127.0.0.1", 0), logRequests=False)
+            self.server.register_instance(type("Root", (object,), {'Bug': self.interface})(),
+                                          allow_dotted_names=True)
+            self.thread = threading.Thread(target=self.server.serve_forever)
+            self.thread.daemon = True
+            self.thread.start()
+
+            self.tempdir = tempfile.mkdtemp()
+            self.config  = dict(config.__dict__)
+            config.path_cache            = os.path.join(self.tempdir, "cache.db")
+            config.bugtracker_url        = "http://127.0.0.1:%d" % self.server.server_address[1]
+            config.bugtracker_user       = "user"
+            config.bugtracker_pass       = "pass"
+            config.bugtracker_batch_size = 3
+            config.bugtracker_jobs       = 4
+
+            self.all_patches = _patchsets(2)
+            for bugid in self.bugs:
+                self.all_patches[(bugid - 1) // 5].fixes.append((True, bugid, "Bug %d" % bugid))
+
+        def tearDown(self):
+            self.server.shutdown()
+            self.server.server_close()
+            shutil.rmtree(self.tempdir)
+            for key, value in self.config.iteritems():
+                if not key.startswith("__"):
+                    setattr(config, key, value)
+
+        def _check(self, sync_bugs=False, offline=False):
+            del self.interface.requests[:]
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                check_bug_status(self.all_patches, sync_bugs=sync_bugs, offline=offline)
+                return sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+
+        def _url(self, bugid):
+            return "%s/tree/master/patches/patchset%d" % (config.github_url, (bugid - 1) // 5)
+
+        def test_sync(self):
+            self.bugs[5]['status'] = "STAGED"
+            self.bugs[5]['cf_staged_patchset'] = self._url(5)
+            self.bugs[5]['cc'] = list(config.bugtracker_defaultcc)
+            output = self._check(sync_bugs=True)
+
+            # Bugs with the same changes are updated together, in batches and in parallel
+            updates = [params for method, params in self.interface.requests if method == "update"]
+            self.assertEqual(sorted([len(params['ids']) for params in updates]), [1, 2, 3, 3])
+            self.assertEqual(sorted([bugid for params in updates for bugid in params['ids']]),
+                             [1, 2, 3, 4, 6, 7, 8, 9, 10])
+            self.assertTrue(self.interface.parallel > 1)
+            for bugid, bug in self.bugs.iteritems():
+                self.assertEqual(bug['status'], "STAGED")
+                self.assertEqual(bug['cf_staged_patchset'], self._url(bugid))
+
+            # Updated bugs don't require attention
+            self.assertFalse("might require attention" in output)
+
+        def test_sync_outdated(self):
+            self._check()
+            self.bugs[3]['status'] = "RESOLVED"
+
+            # Cached information is not used to update bugs
+            output = self._check(sync_bugs=True)
+            updates = [params for method, params in self.interface.requests if method == "update"]
+            self.assertFalse(3 in [bugid for params in updates for bugid in params['ids']])
+            self.assertEqual(self.bugs[3]['status'], "RESOLVED")
+            self.assertTrue("#3 - \"Bug 3\" - RESOLVED" in output)
+
+        def test_cache(self):
+            self._check()
+            self.assertEqual(sorted([method for method, _ in self.interface.requests]),
+                             ["get", "get", "get", "get", "search"])
+
+            # Results are reused until they are older than the TTL
+            self._check()
+            self.assertEqual(self.interface.requests, [])
+
+            config.bugtracker_cache_ttl = -1
+            self._check()
+            self.assertEqual(sorted([method for method, _ in self.interface.requests]),
+                             ["get", "get", "get", "get", "search"])
+
+        def test_offline(self):
+            output = self._check(offline=True)
+            self.assertEqual(self.interface.requests, [])
+            self.assertTrue("10 bugs were not checked" in output)
+
+            self._check()
+            self.bugs[1]['status'] = "RESOLVED"
+            config.bugtracker_cache_ttl = -1
+            output = self._check(offline=True)
+            self.assertEqual(self.interface.requests, [])
+            self.assertTrue("#1 - \"Bug 1\" - NEW" in output)
+
+    unittest.main()
@@ -19,18 +19,19 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
 #
 
+import bisect
 import collections
-import difflib
 import email.header
 import hashlib
 import itertools
+import mmap
 import os
 import re
-import shutil
 import stat
 import subprocess
 import sys
 import tempfile
+import threading
 
 try:
     from cStringIO import StringIO
@@ -47,6 +48,10 @@ class PatchApplyError(RuntimeError):
     """Failed to apply/merge patch."""
     pass
 
+class PatchUnsupportedError(RuntimeError):
+    """Patch uses features which are not supported by the builtin implementation."""
+    pass
+
 class PatchDiffError(RuntimeError):
     """Failed to compute diff."""
     pass
@@ -55,6 +60,128 @@ class CParserError(RuntimeError):
     """Unable to parse C source."""
     pass
 
+class MemoryFile(object):
+    """Replacement for NamedTemporaryFile which keeps the content in memory. The content is
+    only written to a temporary file when the name is accessed (for external tools), the
+    file descriptor is closed immediately afterwards."""
+
+    def __init__(self, content=""):
+        self.fp    = StringIO()
+        self.fp.write(content)
+        self.fp.seek(0)
+        self.path  = None
+        self.dirty = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.fp)
+
+    @property
+    def name(self):
+        """Return the name of a temporary file with the current content."""
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp()
+        elif self.dirty:
+            fd = os.open(self.path, os.O_WRONLY | os.O_TRUNC)
+        else:
+            return self.path
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(self.fp.getvalue())
+        self.dirty = False
+        return self.path
+
+    def close(self):
+        if self.path is not None:
+            os.unlink(self.path)
+            self.path = None
+
+    def getvalue(self):
+        return self.fp.getvalue()
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def readline(self):
+        return self.fp.readline()
+
+    def seek(self, pos, whence=0):
+        self.fp.seek(pos, whence)
+
+    def tell(self):
+        return self.fp.tell()
+
+    def write(self, data):
+        self.dirty = True
+        self.fp.write(data)
+
+    def flush(self):
+        pass
+
+_re_hunk_header  = re.compile("^@@ -([0-9]+)(,([0-9]+))? \+([0-9]+)(,([0-9]+))? @@")
+_re_index_header = re.compile("^index ([a-fA-F0-9]*)\.\.([a-fA-F0-9]*)")
+_re_binary_type  = re.compile("^(literal|delta) ([0-9]+)")
+
+# Memory maps of recently used patch files, indexed by filename
+_mapped_files       = collections.OrderedDict()
+_mapped_files_limit = 64
+_mapped_files_lock  = threading.Lock()
+
+def _map_file(filename):
+    """Return a read-only memory map of a file (or an empty string for empty files)."""
+    with open(filename, "rb") as fp:
+        st  = os.fstat(fp.fileno())
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+        with _mapped_files_lock:
+            entry = _mapped_files.pop(filename, None)
+        if entry is None or entry[0] != key:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else ""
+            entry = (key, data)
+
+    # Maps which are still in use are closed as soon as the last reference is gone
+    with _mapped_files_lock:
+        _mapped_files[filename] = entry
+        while len(_mapped_files) > _mapped_files_limit:
+            _mapped_files.popitem(last=False)
+    return entry[1]
+
+def reinit_after_fork():
+    """Reset the caches and locks inherited from the parent process, they might be in an
+    inconsistent state if other threads were using them while forking."""
+    global _mapped_files, _mapped_files_lock, _preprocessed
+    _mapped_files      = collections.OrderedDict()
+    _mapped_files_lock = threading.Lock()
+    _preprocessed      = collections.OrderedDict()
+
+def _open_mapped(filename):
+    """Open a file for reading with a private memory map, which supports readline(), seek() and tell()."""
+    with open(filename, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return StringIO("")
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _read_content(fp):
+    """Return the full content of a MemoryFile or named file object."""
+    if isinstance(fp, MemoryFile):
+        return fp.getvalue()
+    with open(fp.name) as tmp:
+        return tmp.read()
+
+# Hunk of a unified diff. srcstart and dststart are the line numbers from the
+# hunk header, prefix and suffix the number of leading and trailing context lines
+# (prefix is None for hunks without changes), noeol is set if the hunk contains
+# a '\\ No newline at end of file' marker.
+_Hunk = collections.namedtuple('_Hunk', ['srcstart', 'srcdata', 'dststart', 'dstdata',
+                                         'prefix', 'suffix', 'noeol'])
+
 class PatchObject(object):
     def __init__(self, filename, header):
         self.patch_author       = header.get('author', None)
@@ -77,29 +204,30 @@ class PatchObject(object):
         self.newmode            = None
 
     def read_chunks(self):
-        """Iterates over arbitrary sized chunks of this patch."""
+        """Iterates over arbitrary sized chunks of this patch (read-only buffers of the mapped file)."""
         assert self.offset_end >= self.offset_begin
-        with open(self.filename) as fp:
-            fp.seek(self.offset_begin)
-            i = self.offset_end - self.offset_begin
-            while i > 0:
-                buf = fp.read(16384 if i > 16384 else i)
-                if buf == "": raise IOError("Unable to extract patch.")
-                yield buf
-                i -= len(buf)
+        data = _map_file(self.filename)
+        if len(data) < self.offset_end: raise IOError("Unable to extract patch.")
+        if self.offset_end > self.offset_begin:
+            yield buffer(data, self.offset_begin, self.offset_end - self.offset_begin)
 
     def read(self):
         """Return the full patch as a string."""
-        return "".join(chunk for chunk in self.read_chunks())
+        assert self.offset_end >= self.offset_begin
+        data = _map_file(self.filename)
+        if len(data) < self.offset_end: raise IOError("Unable to extract patch.")
+        return data[self.offset_begin:self.offset_end]
 
 class _PatchReader(object):
     def __init__(self, filename, fp=None):
         self.filename = filename
-        self.fp       = fp if fp is not None else open(filename)
+        self.owned    = fp is None
+        self.fp       = fp if fp is not None else _open_mapped(filename)
         self.peeked   = None
 
     def close(self):
-        self.fp.close()
+        if self.owned:
+            self.fp.close()
 
     def __enter__(self):
         return self
@@ -148,22 +276,76 @@ class _PatchReader(object):
 
     def read_hunk(self):
         """Read one hunk from a patch file."""
+        hunk = self.read_hunk_context()
+        if hunk is None:
+            return None
+        return (max(hunk.srcstart - 1, 0), hunk.srcdata, max(hunk.dststart - 1, 0), hunk.dstdata)
+
+    def _read_hunk_header(self):
+        """Read the header of a hunk, returns (srcstart, srclines, dststart, dstlines) or None."""
         line = self.peek()
         if line is None or not line.startswith("@@ -"):
             return None
 
-        r = re.match("^@@ -([0-9]+)(,([0-9]+))? \+([0-9]+)(,([0-9]+))? @@", line)
+        r = _re_hunk_header.match(line)
         if not r: raise PatchParserError("Unable to parse hunk header '%s'." % line)
-        srcpos   = max(int(r.group(1)) - 1, 0)
-        dstpos   = max(int(r.group(4)) - 1, 0)
+        srcstart = int(r.group(1))
+        dststart = int(r.group(4))
         srclines = int(r.group(3)) if r.group(3) else 1
         dstlines = int(r.group(6)) if r.group(6) else 1
         if srclines <= 0 and dstlines <= 0:
             raise PatchParserError("Empty hunk doesn't make sense.")
         self.read()
+        return srcstart, srclines, dststart, dstlines
+
+    def skip_hunk(self):
+        """Skip over one hunk in a patch file, returns False if there is no hunk."""
+        header = self._read_hunk_header()
+        if header is None:
+            return False
+        _, srclines, _, dstlines = header
+
+        readline = self.fp.readline
+        while srclines > 0 or dstlines > 0:
+            c = readline()[:1]
+            if c == " ":
+                if srclines == 0 or dstlines == 0:
+                    raise PatchParserError("Corrupted patch.")
+                srclines -= 1
+                dstlines -= 1
+            elif c == "-":
+                if srclines == 0:
+                    raise PatchParserError("Corrupted patch.")
+                srclines -= 1
+            elif c == "+":
+                if dstlines == 0:
+                    raise PatchParserError("Corrupted patch.")
+                dstlines -= 1
+            elif c == "\\":
+                pass
+            elif c == "\n" or c == "":
+                raise PatchParserError("Truncated patch.")
+            else:
+                raise PatchParserError("Unexpected line in hunk.")
+
+        while True:
+            line = self.peek()
+            if line is None or not line.startswith("\\ "): break
+            self.read()
+        return True
+
+    def read_hunk_context(self):
+        """Read one hunk from a patch file, including the information required to apply it."""
+        header = self._read_hunk_header()
+        if header is None:
+            return None
+        srcstart, srclines, dststart, dstlines = header
 
         srcdata = []
         dstdata = []
+        prefix  = None
+        suffix  = 0
+        noeol   = False
 
         try:
             while srclines > 0 or dstlines > 0:
@@ -175,29 +357,35 @@ class _PatchReader(object):
                     dstdata.append(line[1:])
                     srclines -= 1
                     dstlines -= 1
+                    suffix += 1
                 elif line[0] == "-":
                     if srclines == 0:
                         raise PatchParserError("Corrupted patch.")
                     srcdata.append(line[1:])
                     srclines -= 1
+                    if prefix is None: prefix = suffix
+                    suffix = 0
                 elif line[0] == "+":
                     if dstlines == 0:
                         raise PatchParserError("Corrupted patch.")
                     dstdata.append(line[1:])
                     dstlines -= 1
+                    if prefix is None: prefix = suffix
+                    suffix = 0
                 elif line[0] == "\\":
-                    pass # ignore
+                    noeol = True
                 else:
                     raise PatchParserError("Unexpected line in hunk.")
-        except IndexError: # triggered by ""[0]
+        except (IndexError, AttributeError): # triggered by ""[0] or None at the end of file
             raise PatchParserError("Truncated patch.")
 
         while True:
             line = self.peek()
             if line is None or not line.startswith("\\ "): break
             self.read()
+            noeol = True
 
-        return (srcpos, srcdata, dstpos, dstdata)
+        return _Hunk(srcstart, srcdata, dststart, dstdata, prefix, suffix, noeol)
 
 def _read_single_patch(fp, header, oldname=None, newname=None):
     """Internal function to read a single patch from a file."""
@@ -246,7 +434,7 @@ def _read_single_patch(fp, header, oldname=None, newname=None):
             pass # ignore
 
         elif line.startswith("index "):
-            r = re.match("^index ([a-fA-F0-9]*)\.\.([a-fA-F0-9]*)", line)
+            r = _re_index_header.match(line)
             if not r: raise PatchParserError("Unable to parse index header line '%s'." % line)
             patch.oldsha1, patch.newsha1 = r.group(1), r.group(2)
 
@@ -280,7 +468,7 @@ def _read_single_patch(fp, header, oldname=None, newname=None):
             raise PatchParserError("Stripped old- and new name doesn't match.")
 
     elif line.startswith("@@ -"):
-        while fp.read_hunk() is not None:
+        while fp.skip_hunk():
             pass
 
     elif line.rstrip() == "GIT binary patch":
@@ -292,7 +480,7 @@ def _read_single_patch(fp, header, oldname=None, newname=None):
 
         line = fp.read()
         if line is None: raise PatchParserError("Unexpected end of file.")
-        r = re.match("^(literal|delta) ([0-9]+)", line)
+        r = _re_binary_type.match(line)
         if not r: raise NotImplementedError("Only literal/delta patches are supported.")
         patch.is_binary = True
 
@@ -385,14 +573,163 @@ def read_patch(filename, fp=None):
             else:
                 fp.read()
 
+def read_hunks(filename, fp=None):
+    """Read all hunks of a patch file, returns a list of (newfile, hunks) tuples (one per file section)."""
+
+    sections = []
+    with _PatchReader(filename, fp) as fp:
+        while True:
+            line = fp.peek()
+            if line is None:
+                break
+
+            elif line.startswith("diff --git "):
+                sections.append((False, []))
+                fp.read()
+
+            elif line.startswith("--- "):
+                newfile = (line[4:].strip() == "/dev/null")
+                if len(sections) == 0 or len(sections[-1][1]) > 0:
+                    sections.append((newfile, []))
+                else:
+                    sections[-1] = (newfile, sections[-1][1])
+                fp.read()
+
+            elif line.startswith("+++ "):
+                if line[4:].strip() == "/dev/null":
+                    raise PatchUnsupportedError("Deleting files is not supported.")
+                fp.read()
+
+            elif line.startswith("@@ -"):
+                if len(sections) == 0:
+                    sections.append((False, []))
+                hunk = fp.read_hunk_context()
+                if hunk.noeol:
+                    raise PatchUnsupportedError("Missing newline at end of file is not supported.")
+                if hunk.prefix is None:
+                    raise PatchUnsupportedError("Hunks without changes are not supported.")
+                sections[-1][1].append(hunk)
+
+            elif line.startswith("GIT binary patch"):
+                raise PatchUnsupportedError("Binary patches are not supported.")
+
+            else:
+                fp.read()
+
+    return sections
+
+def _locate_hunk(lines, pattern, first, guess, frozen, prefix, suffix):
+    """Find the position where a hunk applies, following the rules of 'patch --fuzz=0'."""
+
+    if len(pattern) == 0:
+        return min(guess, len(lines))
+
+    # Hunks with fewer leading than trailing context lines can only match at the
+    # beginning of the file, hunks with fewer trailing than leading context lines
+    # only at the end of the file.
+    context     = max(prefix, suffix)
+    prefix_fuzz = prefix - context
+    suffix_fuzz = suffix - context
+
+    # Never try positions overlapping with the previous hunk
+    max_pos = len(lines) - len(pattern) + suffix_fuzz - guess
+    max_neg = guess - frozen
+
+    def _match(pos):
+        if pos < 0 or pos + len(pattern) > len(lines):
+            return False
+        return lines[pos] == pattern[0] and lines[pos:pos + len(pattern)] == pattern
+
+    if prefix_fuzz < 0 and first <= 1:
+        if frozen <= prefix and -guess <= max_pos and _match(0):
+            return 0
+        return None
+
+    if suffix_fuzz < 0:
+        pos = len(lines) - len(pattern)
+        if pos >= 0 and guess - pos <= max_neg and _match(pos):
+            return pos
+        return None
+
+    for offset in xrange(0, max(max_pos, max_neg) + 1):
+        if offset <= max_pos and _match(guess + offset):
+            return guess + offset
+        if offset <= max_neg and _match(guess - offset):
+            return guess - offset
+
+    return None
+
+def apply_hunks(lines, hunks, reverse=False, positions=None):
+    """Apply the hunks of a single file section to a list of lines - behaves like 'patch --fuzz=0'.
+    If positions is given, the line number where each hunk was applied is appended to it."""
+
+    result = []
+    frozen = 0
+    offset = 0
+
+    for hunk in hunks:
+        if reverse:
+            start, srcdata, dstdata = hunk.dststart, hunk.dstdata, hunk.srcdata
+        else:
+            start, srcdata, dstdata = hunk.srcstart, hunk.srcdata, hunk.dstdata
+
+        # Pure insertions are done after the given line
+        first = start if len(srcdata) else start + 1
+        pos = _locate_hunk(lines, srcdata, first, first - 1 + offset, frozen, hunk.prefix, hunk.suffix)
+        if pos is None or pos < frozen:
+            raise PatchApplyError("Failed to apply hunk.")
+        offset = pos - (first - 1)
+        if positions is not None:
+            positions.append(pos)
+
+        result.extend(lines[frozen:pos + hunk.prefix])
+        result.extend(dstdata[hunk.prefix:len(dstdata) - hunk.suffix])
+        frozen = pos + len(srcdata) - hunk.suffix
+
+    result.extend(lines[frozen:])
+    return result
+
+def split_lines(content):
+    """Split the content of a file into a list of lines."""
+    if content == "":
+        return []
+    if not content.endswith("\n"):
+        raise PatchUnsupportedError("Missing newline at end of file is not supported.")
+    return content[:-1].split("\n")
+
+def apply_sections(lines, sections, reverse=False):
+    """Apply all file sections returned by read_hunks() to a list of lines."""
+    for newfile, hunks in sections:
+        if newfile and (reverse or len(lines)):
+            raise PatchUnsupportedError("Creating files is only supported on empty files.")
+        lines = apply_hunks(lines, hunks, reverse=reverse)
+    return lines
+
+def _apply_patch_internal(original, patchfile, reverse=False):
+    """Apply a patch without fuzz in-process."""
+
+    sections = read_hunks(None, StringIO(_read_content(patchfile)))
+    lines = split_lines(_read_content(original))
+
+    lines = apply_sections(lines, sections, reverse=reverse)
+
+    if len(lines):
+        return MemoryFile("\n".join(lines) + "\n")
+    return MemoryFile()
+
 def apply_patch(original, patchfile, reverse=False, fuzz=2):
-    """Apply a patch with optional fuzz - uses the commandline 'patch' utility."""
+    """Apply a patch with optional fuzz - uses the commandline 'patch' utility if fuzz is required
+    or the patch contains features not supported by the builtin implementation."""
+
+    if fuzz == 0:
+        try:
+            return _apply_patch_internal(original, patchfile, reverse=reverse)
+        except PatchUnsupportedError:
+            pass
 
     result = tempfile.NamedTemporaryFile(mode='w+', delete=False)
     try:
-        # We open the file again to avoid race-conditions with multithreaded reads
-        with open(original.name) as fp:
-            shutil.copyfileobj(fp, result)
+        result.write(_read_content(original))
         result.close()
 
         cmdline = ["patch", "--no-backup-if-mismatch", "--force", "--silent", "-r", "-"]
@@ -404,95 +741,539 @@ def apply_patch(original, patchfile, reverse=False, fuzz=2):
         if exitcode != 0:
             raise PatchApplyError("Failed to apply patch (exitcode %d)." % exitcode)
 
-        # Hack - we can't keep the file open while patching ('patch' might rename/replace
-        # the file), so create a new _TemporaryFileWrapper object for the existing path.
-        return tempfile._TemporaryFileWrapper(file=open(result.name, 'r+'), \
-                                              name=result.name, delete=True)
-    except:
+        # We can't keep the file open while patching ('patch' might rename/replace
+        # the file), so read the result again afterwards.
+        with open(result.name) as fp:
+            return MemoryFile(fp.read())
+    finally:
         os.unlink(result.name)
-        raise
-
-def _preprocess_source(fp):
-    """Simple C preprocessor to determine where we can safely add #ifdef instructions."""
-
-    _re_state0 = re.compile("(\"|/[/*])")
-    _re_state1 = re.compile("(\\\\\"|\\\\\\\\|\")")
-    _re_state2 = re.compile("\\*/")
-
-    # We need to read the original file, and figure out where lines can be splitted
-    lines = []
-    for line in fp:
-        lines.append(line.rstrip("\n"))
-
-    split = set([0])
-    state = 0
-
-    i = 0
-    while i < len(lines):
-
-        # Read a full line (and handle line continuation)
-        line = lines[i]
-        i += 1
-        while line.endswith("\\"):
-            if i >= len(lines):
-                raise CParserError("Unexpected end of file.")
-            line = line[:-1] + lines[i]
-            i += 1
-
-        # To find out where we can add our #ifdef tags we use a simple
-        # statemachine. This allows finding the beginning of a multiline
-        # instruction or comment.
-        j = 0
-        while True:
 
-            # State 0: No context
-            if state == 0:
-                match = _re_state0.search(line, j)
-                if match is None: break
-
-                if match.group(0) == "\"":
-                    state = 1 # Begin of string
-                elif match.group(0) == "/*":
-                    state = 2 # Begin of comment
-                elif match.group(0) == "//":
-                    break # Rest of the line is a comment, which can be safely ignored
+#
+# In-process diff engine, a port of the 'git diff --minimal' code path of libxdiff (Myers
+# algorithm without heuristics, followed by the compaction and indent heuristic of git).
+#
+
+_XDL_LINE_MAX           = sys.maxint
+_XDL_MAX_INDENT         = 200
+_XDL_MAX_BLANKS         = 20
+_XDL_INDENT_MAX_SLIDING = 100
+
+def _split_records(content):
+    """Split the content of a file into records, each record includes the trailing newline."""
+    records = content.split("\n")
+    last = records.pop()
+    records = [r + "\n" for r in records]
+    if last != "":
+        records.append(last)
+    return records
+
+def _common_prefix(a, b, limit):
+    """Return the length of the common prefix of two lists, at most limit."""
+    n, step = 0, 64
+    while step > 0:
+        while n + step <= limit and a[n:n + step] == b[n:n + step]:
+            n += step
+        step //= 4
+    return n
+
+def _next_flag(rchg, i, value, limit):
+    """Return the index of the next record with the given change flag, or limit."""
+    try:
+        return min(rchg.index(value, i + 1) - 1, limit)
+    except ValueError:
+        return limit
+
+def _xdl_recs_cmp(ha1, ha2, rindex1, rindex2, rchg1, rchg2):
+    """Find the shortest edit script for the remaining records (without any heuristics)."""
+    ndiags = len(ha1) + len(ha2) + 3
+    kvdf   = [0] * ndiags
+    kvdb   = [0] * ndiags
+    base   = len(ha2) + 1
+
+    stack = [(0, len(ha1), 0, len(ha2))]
+    while len(stack):
+        off1, lim1, off2, lim2 = stack.pop()
+
+        # Shrink the box by walking through each diagonal snake
+        while off1 < lim1 and off2 < lim2 and ha1[off1] == ha2[off2]:
+            off1 += 1
+            off2 += 1
+        while off1 < lim1 and off2 < lim2 and ha1[lim1 - 1] == ha2[lim2 - 1]:
+            lim1 -= 1
+            lim2 -= 1
+
+        # If one dimension is empty, all records of the other one were changed
+        if off1 == lim1:
+            for i in xrange(off2, lim2):
+                rchg2[rindex2[i] + 1] = 1
+            continue
+        elif off2 == lim2:
+            for i in xrange(off1, lim1):
+                rchg1[rindex1[i] + 1] = 1
+            continue
+
+        # Search for the middle snake
+        dmin, dmax = off1 - lim2, lim1 - off2
+        fmid, bmid = off1 - off2, lim1 - lim2
+        odd = (fmid - bmid) & 1
+        fmin = fmax = fmid
+        bmin = bmax = bmid
+        kvdf[base + fmid] = off1
+        kvdb[base + bmid] = lim1
+        split = None
+
+        while split is None:
+            if fmin > dmin:
+                fmin -= 1
+                kvdf[base + fmin - 1] = -1
+            else:
+                fmin += 1
+            if fmax < dmax:
+                fmax += 1
+                kvdf[base + fmax + 1] = -1
+            else:
+                fmax -= 1
+
+            for d in xrange(fmax, fmin - 1, -2):
+                if kvdf[base + d - 1] >= kvdf[base + d + 1]:
+                    i1 = kvdf[base + d - 1] + 1
                 else:
-                    assert 0
-
-            # State 1: Inside of string
-            elif state == 1:
-                match = _re_state1.search(line, j)
-                if match is None:
-                    raise CParserError("Line ended in the middle of a string.")
-
-                if match.group(0) == "\"":
-                    state = 0 # End of string
-                elif match.group(0) != "\\\"" and match.group(0) != "\\\\":
-                    assert 0
-
-            # State 2: Multiline comment
-            elif state == 2:
-                match = _re_state2.search(line, j)
-                if match is None: break
-
-                if match.group(0) == "*/":
-                    state = 0 # End of comment
+                    i1 = kvdf[base + d + 1]
+                i2 = i1 - d
+                while i1 < lim1 and i2 < lim2 and ha1[i1] == ha2[i2]:
+                    i1 += 1
+                    i2 += 1
+                kvdf[base + d] = i1
+                if odd and bmin <= d <= bmax and kvdb[base + d] <= i1:
+                    split = (i1, i2)
+                    break
+            if split is not None:
+                break
+
+            if bmin > dmin:
+                bmin -= 1
+                kvdb[base + bmin - 1] = _XDL_LINE_MAX
+            else:
+                bmin += 1
+            if bmax < dmax:
+                bmax += 1
+                kvdb[base + bmax + 1] = _XDL_LINE_MAX
+            else:
+                bmax -= 1
+
+            for d in xrange(bmax, bmin - 1, -2):
+                if kvdb[base + d - 1] < kvdb[base + d + 1]:
+                    i1 = kvdb[base + d - 1]
                 else:
-                    assert 0
+                    i1 = kvdb[base + d + 1] - 1
+                i2 = i1 - d
+                while i1 > off1 and i2 > off2 and ha1[i1 - 1] == ha2[i2 - 1]:
+                    i1 -= 1
+                    i2 -= 1
+                kvdb[base + d] = i1
+                if not odd and fmin <= d <= fmax and i1 <= kvdf[base + d]:
+                    split = (i1, i2)
+                    break
+
+        stack.append((split[0], lim1, split[1], lim2))
+        stack.append((off1, split[0], off2, split[1]))
+
+def _xdl_get_indent(record):
+    """Return the indentation of a record, or -1 if it only contains whitespace."""
+    ret = 0
+    for c in record:
+        if c not in " \t\n\v\f\r":
+            return ret
+        elif c == " ":
+            ret += 1
+        elif c == "\t":
+            ret += 8 - ret % 8
+        if ret >= _XDL_MAX_INDENT:
+            return _XDL_MAX_INDENT
+    return -1
+
+def _xdl_split_score(records, split):
+    """Return the (effective indent, penalty) of splitting the records before the given index."""
+    if split >= len(records):
+        end_of_file, indent = True, -1
+    else:
+        end_of_file, indent = False, _xdl_get_indent(records[split])
+
+    pre_blank, pre_indent = 0, -1
+    for i in xrange(split - 1, -1, -1):
+        pre_indent = _xdl_get_indent(records[i])
+        if pre_indent != -1:
+            break
+        pre_blank += 1
+        if pre_blank == _XDL_MAX_BLANKS:
+            pre_indent = 0
+            break
+
+    post_blank, post_indent = 0, -1
+    for i in xrange(split + 1, len(records)):
+        post_indent = _xdl_get_indent(records[i])
+        if post_indent != -1:
+            break
+        post_blank += 1
+        if post_blank == _XDL_MAX_BLANKS:
+            post_indent = 0
+            break
+
+    penalty = 0
+    if pre_indent == -1 and pre_blank == 0:
+        penalty += 1    # start of file
+    if end_of_file:
+        penalty += 21   # end of file
+
+    post_blank  = 1 + post_blank if indent == -1 else 0
+    total_blank = pre_blank + post_blank
+    penalty += -30 * total_blank + 6 * post_blank
+
+    if indent == -1:
+        indent = post_indent
+    any_blanks = (total_blank != 0)
+
+    if indent == -1 or pre_indent == -1:
+        pass
+    elif indent > pre_indent:
+        penalty += 10 if any_blanks else -4
+    elif indent == pre_indent:
+        pass
+    elif post_indent != -1 and post_indent > indent:
+        penalty += 17 if any_blanks else 24
+    else:
+        penalty += 17 if any_blanks else 23
+
+    return indent, penalty
+
+def _xdl_change_compact(records, ha, rchg, rchgo):
+    """Move groups of changes to the most intuitive position (like git with indent heuristic)."""
+    nrec = len(records)
+
+    def group_next(rchg, n, g):
+        if g[1] == n:
+            return False
+        g[0] = g[1] + 1
+        g[1] = g[0]
+        while rchg[g[1] + 1]:
+            g[1] += 1
+        return True
+
+    def group_previous(rchg, g):
+        if g[0] == 0:
+            return False
+        g[1] = g[0] - 1
+        g[0] = g[1]
+        while rchg[g[0]]:
+            g[0] -= 1
+        return True
+
+    def slide_down(g):
+        if g[1] < nrec and ha[g[0]] == ha[g[1]]:
+            rchg[g[0] + 1] = 0
+            rchg[g[1] + 1] = 1
+            g[0] += 1
+            g[1] += 1
+            while rchg[g[1] + 1]:
+                g[1] += 1
+            return True
+        return False
+
+    def slide_up(g):
+        if g[0] > 0 and ha[g[0] - 1] == ha[g[1] - 1]:
+            g[0] -= 1
+            g[1] -= 1
+            rchg[g[0] + 1] = 1
+            rchg[g[1] + 1] = 0
+            while rchg[g[0]]:
+                g[0] -= 1
+            return True
+        return False
+
+    nreco = len(rchgo) - 2
+    g  = [0, 0]
+    go = [0, 0]
+    while rchg[g[1] + 1]:
+        g[1] += 1
+    while rchgo[go[1] + 1]:
+        go[1] += 1
+
+    while True:
+        if g[1] != g[0]:
+
+            # Shift the change up and then down as far as possible, merge with other changes
+            while True:
+                groupsize = g[1] - g[0]
+                end_matching_other = -1
+
+                while slide_up(g):
+                    if not group_previous(rchgo, go):
+                        raise AssertionError("group sync broken sliding up")
+
+                earliest_end = g[1]
+                if go[1] > go[0]:
+                    end_matching_other = g[1]
+
+                while slide_down(g):
+                    if not group_next(rchgo, nreco, go):
+                        raise AssertionError("group sync broken sliding down")
+                    if go[1] > go[0]:
+                        end_matching_other = g[1]
+
+                if groupsize == g[1] - g[0]:
+                    break
+
+            if g[1] == earliest_end:
+                pass # no shifting was possible
+
+            elif end_matching_other != -1:
+                # Line up with the last group of changes in the other file
+                while go[1] == go[0]:
+                    if not slide_up(g):
+                        raise AssertionError("match disappeared")
+                    if not group_previous(rchgo, go):
+                        raise AssertionError("group sync broken sliding to match")
 
             else:
-                raise CParserError("Internal state error.")
-            j = match.end()
+                # Indent heuristic, pick the shift with the lowest score
+                shift = max(earliest_end, g[1] - groupsize - 1, g[1] - _XDL_INDENT_MAX_SLIDING)
+                best_shift = -1
+                best_score = None
+                for shift in xrange(shift, g[1] + 1):
+                    indent1, penalty1 = _xdl_split_score(records, shift)
+                    indent2, penalty2 = _xdl_split_score(records, shift - groupsize)
+                    score = (indent1 + indent2, penalty1 + penalty2)
+                    if best_shift == -1 or 60 * cmp(score[0], best_score[0]) + (score[1] - best_score[1]) <= 0:
+                        best_score = score
+                        best_shift = shift
+
+                while g[1] > best_shift:
+                    if not slide_up(g):
+                        raise AssertionError("best shift unreached")
+                    if not group_previous(rchgo, go):
+                        raise AssertionError("group sync broken sliding to blank line")
+
+        if not group_next(rchg, nrec, g):
+            break
+        if not group_next(rchgo, nreco, go):
+            raise AssertionError("group sync broken moving to next group")
+
+        # Skip over unchanged records in both files
+        if g[0] == g[1] and go[0] == go[1]:
+            skip = min(_next_flag(rchg, g[0], 1, nrec) - g[0], _next_flag(rchgo, go[0], 1, nreco) - go[0]) - 1
+            if skip > 0:
+                g  = [g[0] + skip] * 2
+                go = [go[0] + skip] * 2
+
+def _diff_changes(records1, records2):
+    """Compute the changes between two lists of records, returns a list of (start1, start2,
+    count1, count2) tuples. The result is identical to 'git diff --minimal'."""
+    classes = dict(itertools.izip(set(records1).union(records2), itertools.count()))
+    ha1 = map(classes.__getitem__, records1)
+    ha2 = map(classes.__getitem__, records2)
+    n1, n2 = len(ha1), len(ha2)
+
+    # Flags for changed records, with an additional unchanged record at both ends
+    rchg1 = [0] * (n1 + 2)
+    rchg2 = [0] * (n2 + 2)
+
+    # Skip common records at the beginning and end
+    dstart = _common_prefix(ha1, ha2, min(n1, n2))
+    dend   = _common_prefix(ha1[::-1], ha2[::-1], min(n1, n2) - dstart)
+
+    # Records which don't occur in the other file are always changed
+    present1, present2 = set(ha1), set(ha2)
+    rindex1 = [i for i in xrange(dstart, n1 - dend) if ha1[i] in present2]
+    rindex2 = [i for i in xrange(dstart, n2 - dend) if ha2[i] in present1]
+    for i in xrange(dstart, n1 - dend):
+        if ha1[i] not in present2: rchg1[i + 1] = 1
+    for i in xrange(dstart, n2 - dend):
+        if ha2[i] not in present1: rchg2[i + 1] = 1
+
+    _xdl_recs_cmp([ha1[i] for i in rindex1], [ha2[i] for i in rindex2], rindex1, rindex2, rchg1, rchg2)
+    return _diff_script(records1, ha1, rchg1, records2, ha2, rchg2)
+
+def _diff_script(records1, ha1, rchg1, records2, ha2, rchg2):
+    """Compact the changed records (flagged at offset 1 in rchg1/rchg2) and return the list
+    of (start1, start2, count1, count2) tuples, like _diff_changes()."""
+    n1, n2 = len(ha1), len(ha2)
+    _xdl_change_compact(records1, ha1, rchg1, rchg2)
+    _xdl_change_compact(records2, ha2, rchg2, rchg1)
+
+    # Collect groups of changes, unchanged records are skipped in both files
+    changes = []
+    i1, i2 = 0, 0
+    while True:
+        skip = min(_next_flag(rchg1, i1, 1, n1) - i1, _next_flag(rchg2, i2, 1, n2) - i2)
+        i1 += skip
+        i2 += skip
+        if i1 >= n1 and i2 >= n2:
+            break
+        l1 = _next_flag(rchg1, i1, 0, n1)
+        l2 = _next_flag(rchg2, i2, 0, n2)
+        changes.append((i1, i2, l1 - i1, l2 - i2))
+        i1, i2 = l1, l2
+
+    return changes
+
+def _diff_hunks(changes, n1, n2, context):
+    """Group changes into hunks with the given number of context lines, returns a list of
+    (start1, end1, start2, end2, changes) tuples."""
+    hunks = []
+    k = 0
+    while k < len(changes):
+        first = last = k
+        while last + 1 < len(changes) and \
+                changes[last + 1][0] - (changes[last][0] + changes[last][2]) <= 2 * context:
+            last += 1
+        k = last + 1
+
+        i1, i2, _, _ = changes[first]
+        e1 = changes[last][0] + changes[last][2]
+        e2 = changes[last][1] + changes[last][3]
+        lctx = min(context, n1 - e1, n2 - e2)
+        hunks.append((max(i1 - context, 0), e1 + lctx, max(i2 - context, 0), e2 + lctx, changes[first:last + 1]))
+    return hunks
+
+def _diff_funcname(record):
+    """Return the function name for a hunk header, or None (default funcname of git)."""
+    if record != "" and (record[0].isalpha() or record[0] in "_$"):
+        return record[:80].rstrip(" \t\n\v\f\r")
+    return None
+
+def _format_diff(records1, records2, changes, context=3):
+    """Format changes like the hunks of 'git diff'."""
+    return "".join(_iter_diff(records1, records2, changes, context))
+
+def _iter_diff(records1, records2, changes, context=3):
+    """Format changes like the hunks of 'git diff', yields the text of one hunk at a time."""
+    funcline, funcprev = "", -1
+
+    def emit(prefix, record):
+        out.append(prefix)
+        out.append(record)
+        if not record.endswith("\n"):
+            out.append("\n\\ No newline at end of file\n")
+
+    for s1, e1, s2, e2, group in _diff_hunks(changes, len(records1), len(records2), context):
+        out = []
+
+        # Search for the function name, otherwise the previous one is used
+        for l in xrange(s1 - 1, funcprev, -1):
+            name = _diff_funcname(records1[l])
+            if name is not None:
+                funcline = name
+                break
+        funcprev = s1 - 1
+
+        header = "@@ -%d" % (s1 + 1 if e1 - s1 else s1)
+        if e1 - s1 != 1: header += ",%d" % (e1 - s1)
+        header += " +%d" % (s2 + 1 if e2 - s2 else s2)
+        if e2 - s2 != 1: header += ",%d" % (e2 - s2)
+        header += " @@"
+        if funcline != "":
+            header = (header + " " + funcline)[:127]
+        out.append(header + "\n")
+
+        for k in xrange(s2, group[0][1]):
+            emit(" ", records2[k])
+
+        pos1, pos2 = group[0][0], group[0][1]
+        for i1, i2, chg1, chg2 in group:
+            for k in xrange(pos2, pos2 + min(i1 - pos1, i2 - pos2)):
+                emit(" ", records2[k])
+            for k in xrange(i1, i1 + chg1):
+                emit("-", records1[k])
+            for k in xrange(i2, i2 + chg2):
+                emit("+", records2[k])
+            pos1, pos2 = i1 + chg1, i2 + chg2
+        for k in xrange(pos2, e2):
+            emit(" ", records2[k])
+
+        yield "".join(out)
+
+# Split points of recently preprocessed sources, indexed by the git blob hash
+_preprocessed       = collections.OrderedDict()
+_preprocessed_limit = 1024
+
+_re_c_code = re.compile(r'(?:[^"/]+|/(?![/*])|"[^"\\\n]*(?:\\.[^"\\\n]*)*"|//[^\n]*)*')
+
+def _scan_source(content, count):
+    """Scan a C source with the given number of lines, returns a bytearray which is nonzero
+    for each line number where #ifdef instructions can be added."""
+    split = bytearray("\x01") * (count + 1)
+
+    # Lines ending with a backslash are continued, the line numbers are mapped from the
+    # joined content to the original lines with the help of the continued lines
+    continued = []
+    lineno, linepos = 0, 0
+    pos = content.find("\\\n")
+    while pos >= 0:
+        lineno += content.count("\n", linepos, pos)
+        linepos = pos
+        continued.append(lineno - len(continued))
+        split[lineno + 1] = 0
+        pos = content.find("\\\n", pos + 2)
+
+    if len(continued):
+        content = content.replace("\\\n", "")
+
+    # The last line must not be continued, the error is raised after scanning the other lines
+    truncated = content.endswith("\\") or (len(continued) and lineno + 1 >= count)
+    if truncated:
+        content = content[:content.rfind("\n") + 1]
+
+    # To find out where we can add our #ifdef tags we skip over code, strings and single line
+    # comments at once. Lines can't be split inside of a multiline comment.
+    lineno, linepos = 0, 0
+    pos = 0
+    while True:
+        pos = _re_c_code.match(content, pos).end()
+        if pos >= len(content): break
+
+        if content[pos] == "\"":
+            raise CParserError("Line ended in the middle of a string.")
 
-        # Only in state 0 (no context) we can split here
-        if state == 0:
-            split.add(i)
+        end = content.find("*/", pos + 2)
+        if end < 0:
+            raise CParserError("Unexpected end of file.")
 
-    # Ensure that the last comment is properly terminated
-    if state != 0:
+        lineno += content.count("\n", linepos, pos)
+        linepos = pos
+        for i in xrange(lineno, lineno + content.count("\n", pos, end)):
+            split[i + bisect.bisect_right(continued, i) + 1] = 0
+        pos = end + 2
+
+    if truncated:
         raise CParserError("Unexpected end of file.")
+    return split
+
+def _preprocess_source(content):
+    """Simple C preprocessor to determine where we can safely add #ifdef instructions. Returns
+    the lines and a bytearray, which is nonzero for each line number where the file can be split."""
+    lines = content.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+
+    # Each blob only has to be scanned once
+    m = hashlib.sha1()
+    m.update("blob %d\0" % len(content))
+    m.update(content)
+    key = m.digest()
+
+    split = _preprocessed.pop(key, None)
+    if split is None:
+        split = _scan_source(content, len(lines))
+
+    _preprocessed[key] = split
+    while len(_preprocessed) > _preprocessed_limit:
+        _preprocessed.popitem(last=False)
     return lines, split
 
+# Version of the output of generate_ifdef_patch(), has to be increased whenever
+# the generated patches change, to invalidate previously cached results.
+IFDEF_VERSION = 2
+
 def generate_ifdef_patch(original, patched, ifdef):
     """Generate a patch which adds #ifdef where necessary to keep both the original and patched version."""
 
@@ -502,170 +1283,155 @@ def generate_ifdef_patch(original, patched, ifdef):
     # (1) determine diff between original file and patched file
     # (2) run the preprocessor, to determine where #ifdefs can be safely added
     # (3) use diff and preprocessor information to create a merged version containing #ifdefs
-    # (4) create another diff to apply the changes on the patched version
+    # (4) emit the diff between the original file and the merged version
     #
 
-    with tempfile.NamedTemporaryFile(mode='w+') as diff:
-        exitcode = subprocess.call(["git", "diff", "--no-index", "--minimal", "-U1", original.name, patched.name],
-                                   stdout=diff, stderr=_devnull)
-        if exitcode == 0:
-            return None
-        elif exitcode != 1:
-            raise PatchDiffError("Failed to compute diff (exitcode %d)." % exitcode)
-
-        # Preprocess the original C source
-        original.seek(0)
-        lines, split = _preprocess_source(original)
+    # Compute the diff between the original and patched file
+    original.seek(0)
+    content  = original.read()
+    records1 = _split_records(content)
+    patched.seek(0)
+    records2 = _split_records(patched.read())
+    changes  = _diff_changes(records1, records2)
+    if len(changes) == 0:
+        return None
+
+    # Preprocess the original C source
+    lines, split = _preprocess_source(content)
+
+    dstlines = [r.rstrip("\n") for r in records2]
+
+    # Hunks are stored as [srcstart, srcend, dststart, dstend] index ranges
+    hunks = []
+    for s1, e1, s2, e2, _ in _diff_hunks(changes, len(records1), len(records2), 1):
+        srcpos = s1 if e1 > s1 else max(s1 - 1, 0)
+        dstpos = s2 if e2 > s2 else max(s2 - 1, 0)
+        srcend = srcpos + (e1 - s1)
+        dstend = dstpos + (e2 - s2)
+
+        # Ensure that the patch would really apply in practice
+        if lines[srcpos:srcend] != [r.rstrip("\n") for r in records1[s1:e1]]:
+            raise PatchParserError("Patch failed to apply.")
+
+        # Strip common lines from the beginning and end
+        while srcpos < srcend and dstpos < dstend and \
+                lines[srcpos] == dstlines[dstpos]:
+            srcpos += 1
+            dstpos += 1
+
+        while srcpos < srcend and dstpos < dstend and \
+                lines[srcend - 1] == dstlines[dstend - 1]:
+            srcend -= 1
+            dstend -= 1
+
+        # Ensure that diff generated valid output
+        assert srcpos < srcend or dstpos < dstend
+
+        # If this is the first hunk, then check if we have to extend it at the beginning
+        if len(hunks) == 0:
+            assert srcpos == dstpos
+            while srcpos > 0 and not split[srcpos]:
+                srcpos -= 1
+                dstpos -= 1
+            hunks.append([srcpos, srcend, dstpos, dstend])
+
+        # Check if we can merge with the previous hunk
+        else:
+            prev = hunks[-1]
+            prev_endpos = prev[1]
 
-        # Parse the created diff file
-        fp = _PatchReader(diff.name, diff)
-        fp.seek(0)
+            # At least two possible splitting positions inbetween
+            if split.count("\x01", prev_endpos, srcpos) >= 2:
+                while not split[prev_endpos]:
+                    prev_endpos += 1
+                prev[3] += prev_endpos - prev[1]
+                prev[1]  = prev_endpos
 
-        # We expect this output format from 'git diff', if this is not the case things might go wrong.
-        line = fp.read()
-        assert line.startswith("diff --git ")
-        line = fp.read()
-        assert line.startswith("index ")
-        line = fp.read()
-        assert line.startswith("--- ")
-        line = fp.read()
-        assert line.startswith("+++ ")
-
-        hunks = []
-        while fp.peek() is not None:
-            srcpos, srcdata, dstpos, dstdata = fp.read_hunk()
-
-            # Ensure that the patch would really apply in practice
-            if lines[srcpos:srcpos + len(srcdata)] != srcdata:
-                raise PatchParserError("Patch failed to apply.")
-
-            # Strip common lines from the beginning and end
-            while len(srcdata) > 0 and len(dstdata) > 0 and \
-                    srcdata[0] == dstdata[0]:
-                srcdata.pop(0)
-                dstdata.pop(0)
-                srcpos += 1
-                dstpos += 1
-
-            while len(srcdata) > 0 and len(dstdata) > 0 and \
-                    srcdata[-1] == dstdata[-1]:
-                srcdata.pop()
-                dstdata.pop()
-
-            # Ensure that diff generated valid output
-            assert len(srcdata) > 0 or len(dstdata) > 0
-
-            # If this is the first hunk, then check if we have to extend it at the beginning
-            if len(hunks) == 0:
-                assert srcpos == dstpos
-                while srcpos > 0 and srcpos not in split:
+                while not split[srcpos]:
                     srcpos -= 1
                     dstpos -= 1
-                    srcdata.insert(0, lines[srcpos])
-                    dstdata.insert(0, lines[srcpos])
-                hunks.append((srcpos, dstpos, srcdata, dstdata))
+                hunks.append([srcpos, srcend, dstpos, dstend])
 
-            # Check if we can merge with the previous hunk
+            # Merge hunks
             else:
-                prev_srcpos, prev_dstpos, prev_srcdata, prev_dstdata = hunks[-1]
-                prev_endpos = prev_srcpos + len(prev_srcdata)
-
-                found = 0
-                for i in xrange(prev_endpos, srcpos):
-                    if i in split:
-                        found += 1
-
-                # At least two possible splitting positions inbetween
-                if found >= 2:
-                    while prev_endpos not in split:
-                        prev_srcdata.append(lines[prev_endpos])
-                        prev_dstdata.append(lines[prev_endpos])
-                        prev_endpos += 1
-
-                    while srcpos not in split:
-                        srcpos -= 1
-                        srcdata.insert(0, lines[srcpos])
-                        dstdata.insert(0, lines[srcpos])
-                    hunks.append((srcpos, dstpos, srcdata, dstdata))
-
-                # Merge hunks
-                else:
-                    while prev_endpos < srcpos:
-                        prev_srcdata.append(lines[prev_endpos])
-                        prev_dstdata.append(lines[prev_endpos])
-                        prev_endpos += 1
-                    assert prev_dstpos + len(prev_dstdata) == dstpos
-                    prev_srcdata.extend(srcdata)
-                    prev_dstdata.extend(dstdata)
-
-            # Ready with this hunk
-            pass
-
-        # We might have to extend the last hunk
-        if len(hunks):
-            prev_srcpos, prev_dstpos, prev_srcdata, prev_dstdata = hunks[-1]
-            prev_endpos = prev_srcpos + len(prev_srcdata)
-
-            while prev_endpos < len(lines) and prev_endpos not in split:
-                prev_srcdata.append(lines[prev_endpos])
-                prev_dstdata.append(lines[prev_endpos])
-                prev_endpos += 1
-
-    # Generate resulting file with #ifdefs
-    with tempfile.NamedTemporaryFile(mode='w+') as intermediate:
-
-        pos = 0
-        while len(hunks):
-            srcpos, dstpos, srcdata, dstdata = hunks.pop(0)
-            if pos < srcpos:
-                intermediate.write("\n".join(lines[pos:srcpos]))
-                intermediate.write("\n")
-
-            if len(srcdata) and len(dstdata):
-                intermediate.write("#if !defined(%s)\n" % ifdef)
-                intermediate.write("\n".join(srcdata))
-                intermediate.write("\n#else  /* %s */\n" % ifdef)
-                intermediate.write("\n".join(dstdata))
-                intermediate.write("\n#endif /* %s */\n" % ifdef)
-
-            elif len(srcdata):
-                intermediate.write("#if !defined(%s)\n" % ifdef)
-                intermediate.write("\n".join(srcdata))
-                intermediate.write("\n#endif /* %s */\n" % ifdef)
-
-            elif len(dstdata):
-                intermediate.write("#if defined(%s)\n" % ifdef)
-                intermediate.write("\n".join(dstdata))
-                intermediate.write("\n#endif /* %s */\n" % ifdef)
+                assert prev[3] + (srcpos - prev_endpos) == dstpos
+                prev[1] = srcend
+                prev[3] = dstend
+
+    # We might have to extend the last hunk
+    if len(hunks):
+        prev = hunks[-1]
+        while prev[1] < len(lines) and not split[prev[1]]:
+            prev[1] += 1
+            prev[3] += 1
+
+    # Generate the records of the resulting file with #ifdefs, and remember which of them were added
+    srcrecords = records1
+    if len(records1) and not records1[-1].endswith("\n"):
+        srcrecords = [l + "\n" for l in lines]
+
+    records3 = []
+    rchg3    = [0]
+
+    def add(data, added):
+        records3.extend(data)
+        rchg3.extend([added] * len(data))
+
+    markers   = ["#if !defined(%s)\n" % ifdef, "#if defined(%s)\n" % ifdef,
+                 "#else  /* %s */\n" % ifdef, "#endif /* %s */\n" % ifdef]
+    known     = set(records1)
+    ambiguous = srcrecords is not records1 or not known.isdisjoint(markers)
+    pos = 0
+    for srcstart, srcend, dststart, dstend in hunks:
+        add(srcrecords[pos:srcstart], 0)
+
+        if dststart < dstend and not ambiguous:
+            ambiguous = not known.isdisjoint([l + "\n" for l in dstlines[dststart:dstend]])
+
+        if srcstart < srcend and dststart < dstend:
+            add(markers[0:1], 1)
+            add(srcrecords[srcstart:srcend], 0)
+            add(markers[2:3], 1)
+            add([l + "\n" for l in dstlines[dststart:dstend]], 1)
+            add(markers[3:4], 1)
+
+        elif srcstart < srcend:
+            add(markers[0:1], 1)
+            add(srcrecords[srcstart:srcend], 0)
+            add(markers[3:4], 1)
+
+        elif dststart < dstend:
+            add(markers[1:2], 1)
+            add([l + "\n" for l in dstlines[dststart:dstend]], 1)
+            add(markers[3:4], 1)
 
-            else:
-                assert 0
-            pos = srcpos + len(srcdata)
-
-        if pos < len(lines):
-            intermediate.write("\n".join(lines[pos:]))
-            intermediate.write("\n")
-        intermediate.flush()
-
-        # Now we can finally compute the diff between the original file and our intermediate file
-        diff = tempfile.NamedTemporaryFile(mode='w+')
-        exitcode = subprocess.call(["git", "diff", "--no-index", "--minimal", original.name, intermediate.name],
-                                   stdout=diff, stderr=_devnull)
-        if exitcode != 1: # exitcode 0 cannot (=shouldn't) happen in this situation
-            raise PatchDiffError("Failed to compute diff (exitcode %d)." % exitcode)
-
-        diff.flush()
-        diff.seek(0)
-
-        # We expect this output format from 'git diff', if this is not the case things might go wrong.
-        line = diff.readline()
-        assert line.startswith("diff --git ")
-        line = diff.readline()
-        assert line.startswith("index ")
-        line = diff.readline()
-        assert line.startswith("--- ")
-        line = diff.readline()
-        assert line.startswith("+++ ")
+        else:
+            assert 0
+        pos = srcend
+
+    add(srcrecords[pos:], 0)
+    rchg3.append(0)
+
+    # The original records are kept unmodified, so the changes are known without computing
+    # another diff if none of the added records occurs anywhere in the original file. Otherwise
+    # there might be several minimal diffs (added lines can be aligned with original lines, also
+    # outside of the hunk), and only a real diff matches the old output. A missing newline at
+    # the end of the original file also changes a record.
+    if ambiguous:
+        changes = _diff_changes(records1, records3)
+    else:
+        classes = {}
+        ha1 = [classes.setdefault(r, len(classes)) for r in records1]
+        ha3 = [classes.setdefault(r, len(classes)) for r in records3]
+        changes = _diff_script(records1, ha1, [0] * (len(records1) + 2), records3, ha3, rchg3)
+    if len(changes) == 0:
+        raise PatchDiffError("Failed to compute diff.")
+
+    # Write the diff one hunk at a time
+    diff = MemoryFile()
+    for hunk in _iter_diff(records1, records3, changes):
+        diff.write(hunk)
+    diff.seek(0)
 
     # Return the final diff
     return diff
@@ -848,6 +1614,25 @@ if __name__ == "__main__":
             lines = patches[2].read().rstrip("\n").split("\n")
             self.assertEqual(lines, source[58:71])
 
+    # Basic tests for MemoryFile
+    class MemoryFileTests(unittest.TestCase):
+        def test_spill(self):
+            fp = MemoryFile("line1\n")
+            self.assertEqual(fp.readline(), "line1\n")
+            fp.write("line2\n")
+
+            filename = fp.name
+            with open(filename) as tmp:
+                self.assertEqual(tmp.read(), "line1\nline2\n")
+
+            fp.write("line3\n")
+            self.assertEqual(fp.name, filename)
+            with open(filename) as tmp:
+                self.assertEqual(tmp.read(), "line1\nline2\nline3\n")
+
+            fp.close()
+            self.assertFalse(os.path.exists(filename))
+
     # Basic tests for apply_patch()
     class PatchApplyTests(unittest.TestCase):
         def test_apply(self):
@@ -881,6 +1666,64 @@ if __name__ == "__main__":
             lines = result.read().rstrip("\n").split("\n")
             self.assertEqual(lines, expected)
 
+        def test_offset(self):
+            source = ["a", "b", "c", "d", "e", "f", "X", "Y", "Z", "j", "X", "Y", "Z", "n"]
+
+            # The offset of previous hunks is used to find the best match
+            patch = ["--- a/test.txt", "+++ b/test.txt",
+                     "@@ -1,3 +1,5 @@", " a", "+NEW1", "+NEW2", " b", " c",
+                     "@@ -9,3 +11,4 @@", " X", "+MARK", " Y", " Z"]
+            sections = read_hunks("unknown.patch", StringIO("\n".join(patch + [""])))
+            self.assertEqual(len(sections), 1)
+            lines = apply_hunks(source, sections[0][1])
+            self.assertEqual(lines, ["a", "NEW1", "NEW2", "b", "c", "d", "e", "f",
+                                     "X", "Y", "Z", "j", "X", "MARK", "Y", "Z", "n"])
+
+            # The offset is reset for each file section
+            patch.insert(8, "--- a/test.txt")
+            patch.insert(9, "+++ b/test.txt")
+            sections = read_hunks("unknown.patch", StringIO("\n".join(patch + [""])))
+            self.assertEqual(len(sections), 2)
+            lines = apply_hunks(source, sections[0][1])
+            lines = apply_hunks(lines, sections[1][1])
+            self.assertEqual(lines, ["a", "NEW1", "NEW2", "b", "c", "d", "e", "f",
+                                     "X", "MARK", "Y", "Z", "j", "X", "Y", "Z", "n"])
+
+            # Hunks must not overlap with lines modified by previous hunks
+            patch = ["--- a/test.txt", "+++ b/test.txt",
+                     "@@ -3,2 +3,3 @@", " c", "+N", " d",
+                     "@@ -2,3 +3,4 @@", " b", " c", "+M", " d"]
+            sections = read_hunks("unknown.patch", StringIO("\n".join(patch + [""])))
+            self.assertRaises(PatchApplyError, apply_hunks, source, sections[0][1])
+
+    # Basic tests for the in-process diff engine
+    class DiffTests(unittest.TestCase):
+        def _diff(self, source1, source2, context):
+            records1 = _split_records("\n".join(source1 + [""]))
+            records2 = _split_records("\n".join(source2 + [""]))
+            return _format_diff(records1, records2, _diff_changes(records1, records2), context)
+
+        def test_indent_heuristic(self):
+            source1 = ["int foo(void)", "{", "    a();", "}", "",
+                       "int bar(void)", "{", "    b();", "}"]
+            source2 = ["int foo(void)", "{", "    a();", "}", "",
+                       "int baz(void)", "{", "    c();", "}", "",
+                       "int bar(void)", "{", "    b();", "}"]
+            expected = ["@@ -5,2 +5,7 @@ int foo(void)", " ",
+                        "+int baz(void)", "+{", "+    c();", "+}", "+",
+                        " int bar(void)", ""]
+            self.assertEqual(self._diff(source1, source2, 1), "\n".join(expected))
+
+        def test_funcname(self):
+            source1 = ["static int func(int a)", "{", "    x();", "    y();",
+                       "    z();", "    w();", "    v();", "}"]
+            source2 = ["static int func(int a)", "{", "    x();", "    y();",
+                       "    z();", "    w();", "    new();", "}"]
+            expected = ["@@ -6,3 +6,3 @@ static int func(int a)",
+                        "     w();", "-    v();", "+    new();", " }", ""]
+            self.assertEqual(self._diff(source1, source2, 1), "\n".join(expected))
+            self.assertEqual(self._diff(source1, source1, 1), "")
+
     # Basic tests for _preprocess_source()
     class PreprocessorTests(unittest.TestCase):
         def test_preprocessor(self):
@@ -898,9 +1741,9 @@ if __name__ == "__main__":
                       "char *z = \"multi\" \\",
                       "          \"line\"",
                       "          \"string\";"]
-            lines, split = _preprocess_source(source)
+            lines, split = _preprocess_source("\n".join(source) + "\n")
             self.assertEqual(lines, source)
-            self.assertEqual(split, set([0, 1, 4, 5, 6, 9, 10, 11, 13, 14]))
+            self.assertEqual([i for i, s in enumerate(split) if s], [0, 1, 4, 5, 6, 9, 10, 11, 13, 14])
 
     # Basic tests for generate_ifdef_patch()
     class GenerateIfdefPatchTests(unittest.TestCase):
@@ -961,6 +1804,46 @@ if __name__ == "__main__":
             lines = diff.read().rstrip("\n").split("\n")
             self.assertEqual(lines, expected)
 
+        def test_repeated_lines(self):
+            source = ["}", "int a;", "}", "}", "}", "}", "int a;", "{", "{", "{", "int b;", "int a;",
+                      "{", "{", "{", "int b;", "int b;", "int a;", "int a;", "int a;", "}", "{",
+                      "int a;", "}", "}", "int a;", "int b;", "int b;", "int b;", "int b;", "}", "{",
+                      "}", "int b;", "}", "{", "{", "}", "}"]
+            source1 = MemoryFile("\n".join(source + [""]))
+
+            source = ["}", "int b;", "}", "}", "}", "}", "int a;", "{", "{", "{", "int b;", "int a;",
+                      "{", "}", "{", "{", "int b;", "{", "int b;", "int b;", "int a;", "int a;", "int a;",
+                      "}", "{", "int a;", "}", "}", "int a;", "int b;", "int b;", "int b;", "int b;", "}",
+                      "{", "}", "int b;", "}", "{", "{", "}", "}"]
+            source2 = MemoryFile("\n".join(source + [""]))
+
+            # Added lines also occur in the original file, the minimal diff has to be
+            # computed, otherwise they would be aligned differently
+            expected = ["@@ -1,5 +1,9 @@",
+                        " }",
+                        "+#if !defined(PATCHED)",
+                        " int a;",
+                        "+#else  /* PATCHED */",
+                        "+int b;",
+                        "+#endif /* PATCHED */",
+                        " }", " }", " }",
+                        "@@ -11,9 +15,16 @@ int a;",
+                        " int b;", " int a;", " {",
+                        "+#if defined(PATCHED)",
+                        "+}",
+                        "+#endif /* PATCHED */",
+                        "+{",
+                        " {",
+                        "+int b;",
+                        "+#if defined(PATCHED)",
+                        " {",
+                        " int b;",
+                        "+#endif /* PATCHED */",
+                        " int b;", " int a;", " int a;"]
+            diff = generate_ifdef_patch(source1, source2, "PATCHED")
+            lines = diff.read().rstrip("\n").split("\n")
+            self.assertEqual(lines, expected)
+
     # Basic tests for escape_sh()
     class EscapeShellTests(unittest.TestCase):
         ascii = "".join([chr(i) for i in range(32, 127)] + \
@@ -36,7 +36,8 @@ def _sig_winch(signum=None, frame=None):
     except IOError:
         # ignore 'IOError: [Errno 25] Inappropriate ioctl for device',
         # which can occur when resizing the window while the output is redirected
-        pass
+        if '_term_width' not in globals():
+            _term_width = int(os.environ.get('COLUMNS', 80)) - 1
 
 try:
     _sig_winch()